@@ -3,19 +3,42 @@ import websockets
 from colorama import Fore, Style
 import json
 import os
+import random
 import rsa
+import sys
+import threading
+import time
+import uuid
+from functools import partial
 from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO
+
+# Modules shared with the command line client live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import (  # noqa: E402
+    MediaWriter, SearchIndex, PROGRESS_MIN_SIZE, direct_media_size,
+    fits_in_frame
+)
 
 # Initialize Flask app and SocketIO
 app = Flask(__name__)
 socket = SocketIO(app)
 
-# Generate RSA keys for the server
+# Generate RSA keys for the bridge
 (public_key, private_key) = rsa.newkeys(1024)
-server_public_key = None
-server_private_key = None
-clients = {}
+
+# Upstream connections are shared per room and run on their own event loop
+subscriptions = {}
+sessions = {}
+upstream_loop = asyncio.new_event_loop()
+threading.Thread(target=upstream_loop.run_forever, daemon=True).start()
+
+# Seconds to wait for the server to hand out a room member's public key
+KEY_REQUEST_TIMEOUT = 5
+
+# Reconnect delays in seconds, doubled after every failed attempt
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
 
 
 def encrypt(message, public_key):
@@ -75,45 +98,211 @@ colors = {
 }
 
 
-class ChatClient:
+class RoomSubscription:
     """
-    Represents a chat client that connects to a chat server.
+    Represents the bridge's upstream connection for a chat room.
+
+    All browser users in the room share one connection. Every message is
+    received and decrypted once, then fanned out to the browsers through
+    the Socket.IO room of the same name.
     """
 
-    def __init__(self, host, port, username, room):
+    def __init__(self, host, port, room):
         """
-        Initializes a new chat client.
+        Initializes a new room subscription.
 
         Args:
             host (str): The host address of the server.
             port (int): The port number of the server.
-            username (str): The username of the client.
-            room (str): The chat room to join.
+            room (str): The chat room to subscribe to.
         """
         self.host = host
         self.port = port
-        self.username = username
         self.room = room
         self.websocket = None
+        self.connect_task = None
+        self.server_public_key = None
+        self.server_private_key = None
+        self.reload_keys = False
+        self.users = {}
+        self.joining = {}
+        self.leaving = set()
+        self.tickets = {}
+        self.joined_at = {}
+        self.peer_keys = {}
+        self.key_requests = {}
+        self.media_transfers = {}
+        self.search_index = SearchIndex(room)
 
     async def connect_to_server(self):
         """
-        Connects to the chat server and joins the specified chat room.
+        Connects to the chat server and starts receiving messages.
         """
         uri = f"ws://{self.host}:{self.port}"
         self.websocket = await websockets.connect(uri)
-        msg = {
+
+        # Start receiving messages from the server
+        asyncio.create_task(self.receive_messages())
+
+    async def join(self, username, sid):
+        """
+        Joins a browser user to the chat room through the shared connection.
+
+        Args:
+            username (str): The username of the browser user.
+            sid (str): The Socket.IO session id of the browser user.
+        """
+        # Registered before connecting, so a leave meanwhile is noticed
+        self.joining[username] = sid
+        if self.connect_task is None:
+            self.connect_task = asyncio.ensure_future(
+                self.connect_to_server()
+            )
+
+        try:
+            await self.connect_task
+        except Exception as e:
+            # Forget the failed subscription so the next join tries again
+            print(f"Error connecting to room {self.room}: {e}")
+            self.connect_task = None
+            self.joining.pop(username, None)
+            self.leaving.discard(username)
+            if subscriptions.get(self.room) is self:
+                del subscriptions[self.room]
+            sessions.pop(sid, None)
+            emit_unavailable(sid, username, self.room)
+            return
+
+        if username in self.leaving:
+            # The user left before the join could be sent
+            self.leaving.remove(username)
+            await self.close_if_unused()
+            return
+        await self.send_message(self.join_message(username))
+
+    def join_message(self, username):
+        """
+        Builds the JOIN_ROOM message of a user, which starts a full key
+        exchange.
+
+        Args:
+            username (str): The username of the browser user.
+
+        Returns:
+            dict: The message to be sent.
+        """
+        return {
             "type": "JOIN_ROOM",
-            "username": self.username,
+            "username": username,
             "room": self.room,
             "code": 200,
             "public_key": public_key.save_pkcs1("PEM").decode()
         }
-        await self.websocket.send(json.dumps(msg))
 
-        # Start receiving messages from the server
-        receive_task = asyncio.create_task(self.receive_messages())
-        await receive_task
+    async def reconnect(self):
+        """
+        Reconnects after the shared connection dropped and resumes every
+        user's session with its ticket, so the cached room keys are kept
+        without a new key exchange.
+        """
+        uri = f"ws://{self.host}:{self.port}"
+        delay = RECONNECT_DELAY
+
+        while subscriptions.get(self.room) is self:
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            try:
+                self.websocket = await websockets.connect(uri)
+                break
+            except OSError as e:
+                print(f"Error reconnecting to room {self.room}: {e}")
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        else:
+            return
+
+        asyncio.create_task(self.receive_messages())
+
+        # Joins of users who already left were lost with the connection
+        self.leaving.clear()
+
+        for username in list(self.users):
+            ticket = self.tickets.pop(username, None)
+            if ticket:
+                msg = {
+                    "type": "RESUME_ROOM",
+                    "username": username,
+                    "room": self.room,
+                    "ticket": ticket
+                }
+            else:
+                self.joining[username] = self.users.pop(username)
+                msg = self.join_message(username)
+            await self.send_message(msg)
+
+        # Joins that were in flight when the connection dropped
+        for username in list(self.joining):
+            await self.send_message(self.join_message(username))
+
+        # Everyone may have left while the connection was down
+        await self.close_if_unused()
+
+    async def leave(self, username, sid):
+        """
+        Removes a browser user from the chat room, and closes the shared
+        connection once no users are left.
+
+        Args:
+            username (str): The username of the browser user.
+            sid (str): The Socket.IO session id leaving, another sid may hold the username.
+        """
+        if self.joining.get(username) == sid:
+            # A join still waiting for the server is left once accepted
+            del self.joining[username]
+            self.leaving.add(username)
+            return
+        if self.users.get(username) != sid:
+            return
+        del self.users[username]
+        self.tickets.pop(username, None)
+        self.joined_at.pop(username, None)
+        socket.server.leave_room(sid, self.room, namespace='/')
+
+        await self.send_leave(username)
+        socket.emit('message_received', {
+            "type": "SYSTEM_MESSAGE",
+            "color": "red",
+            "message": f"{username} has left the chat room.",
+            "code": 400
+        }, to=self.room)
+
+        await self.close_if_unused()
+
+    async def send_leave(self, username):
+        """
+        Tells the chat server that a browser user left the room.
+
+        Args:
+            username (str): The username of the browser user.
+        """
+        msg = {
+            "type": "LEAVE_ROOM",
+            "username": username,
+            "room": self.room,
+            "code": 400
+        }
+        await self.send_message(msg)
+
+    async def close_if_unused(self):
+        """
+        Closes the shared connection once no users are joined, joining or
+        waiting to be left.
+        """
+        if self.users or self.joining or self.leaving:
+            return
+
+        if subscriptions.get(self.room) is self:
+            del subscriptions[self.room]
+        self.search_index.save()
+        await self.disconnect()
 
     async def send_message(self, message):
         """
@@ -126,77 +315,469 @@ class ChatClient:
 
     async def receive_messages(self):
         """
-        Receives messages from the chat server and handles them.
+        Receives messages from the chat server and fans them out to the
+        browser users in the room.
         """
-        global server_public_key, server_private_key, clients
-
         while True:
             try:
                 message_raw = await self.websocket.recv()
-                message = json.loads(message_raw)
-
-                if message["type"] == "SYSTEM_MESSAGE":
-                    # Emit system message to the client
-                    emit('message_received', message)
-                    if message["code"] == 409:
-                        # Handle username conflict
-                        continue
-                    elif message["code"] == 400:
-                        # Remove client from the room
-                        clients[message["room"]].pop(message["username"])
-
-                    elif not server_public_key and not server_private_key:
-                        # Decrypt and load server's public and private keys
-                        pub_key = bytes.fromhex(message["public_key"])
-                        server_public_key = rsa.PublicKey.load_pkcs1(
-                            decrypt(pub_key, private_key)
-                        )
-
-                        pri_key = bytes.fromhex(message["private_key"])
-                        server_private_key = rsa.PrivateKey.load_pkcs1(
-                            decrypt(pri_key, private_key)
-                        )
-
-                if message["type"] == "USER_MESSAGE" and message["message"]:
-                    # Decrypt and emit user message
-                    toSend = bytes.fromhex(message["message"])
-                    toSend = decrypt(toSend, server_private_key)
-                    message["message"] = toSend
-                    emit('message_received', message)
-
-                if message["type"] == "MEDIA_MESSAGE":
-                    # Handle incoming media message
-                    media_encoded = message["message"]
-                    filename = message.get("filename", "unknown")
-
-                    emit('message_received', message)
-
-                    if not os.path.exists("received_media"):
-                        os.makedirs("received_media")
-
-                    media_bytes = bytes.fromhex(media_encoded)
-                    media_path = os.path.join("received_media", filename)
-                    with open(media_path, "wb") as f:
-                        f.write(media_bytes)
-
-                    emit('message_received', message)
-
-            except websockets.exceptions.ConnectionClosedError:
-                print("Connection closed by the server.")
+            except websockets.exceptions.ConnectionClosed:
+                print(f"Connection to room {self.room} closed.")
+                self.discard_media_transfers()
+                if subscriptions.get(self.room) is self:
+                    asyncio.create_task(self.reconnect())
                 break
-
             except Exception as e:
                 print(f"Error receiving message: {e}")
+                await self.abandon()
                 break
 
+            # A malformed message must not stop the room's only receive loop
+            try:
+                await self.handle_message(json.loads(message_raw))
+            except Exception as e:
+                print(f"Error handling message from room {self.room}: {e}")
+
+    async def handle_message(self, message):
+        """
+        Handles a message from the chat server.
+
+        Args:
+            message (dict): The decoded message.
+        """
+        if message["type"] == "SYSTEM_MESSAGE":
+            if message["code"] == 409 and "username" in message:
+                # Handle username conflict of a joining user
+                sid = self.joining.pop(message["username"], None)
+                if sid:
+                    # The name belongs to someone else, so the sid must not
+                    # leave it on disconnect
+                    if sessions.get(sid) == (self.room, message["username"]):
+                        del sessions[sid]
+                    socket.emit('message_received', message, to=sid)
+                self.leaving.discard(message["username"])
+                await self.close_if_unused()
+                return
+
+            elif message["code"] == 401:
+                # The session could not be resumed, rejoin with a
+                # new key exchange in case the room keys changed
+                sid = self.users.pop(message["username"], None)
+                if sid:
+                    self.reload_keys = True
+                    self.joining[message["username"]] = sid
+                    await self.send_message(
+                        self.join_message(message["username"])
+                    )
+                return
+
+            elif message["code"] == 200 and message.get("resumed"):
+                self.tickets[message["username"]] = message["ticket"]
+                return
+
+            elif message["code"] == 200 and "public_key" in message:
+                await self.joined(message)
+                return
+
+            elif message["code"] in (403, 404):
+                # A direct message could not be delivered
+                sid = self.users.get(message["username"])
+                if sid:
+                    socket.emit('message_received', message, to=sid)
+                return
+
+            elif message["code"] == 400:
+                # The member left, a new session has a new key
+                self.peer_keys.pop(message["username"], None)
+
+            socket.emit('message_received', message, to=self.room)
+
+        if message["type"] == "PUBLIC_KEY":
+            future = self.key_requests.pop(message["username"], None)
+            if future and not future.done():
+                future.set_result(message["public_key"])
+
+        if message["type"] == "DIRECT_MESSAGE" and message["message"]:
+            # Decrypt and emit only to the recipient, direct messages
+            # stay out of the room's shared search index
+            sid = self.users.get(message["recipient"])
+            if sid:
+                toSend = bytes.fromhex(message["message"])
+                message["message"] = decrypt(toSend, private_key)
+                socket.emit('message_received', message, to=sid)
+
+        if message["type"] == "USER_MESSAGE" and message["message"]:
+            # Decrypt once and emit user message to the whole room
+            toSend = bytes.fromhex(message["message"])
+            toSend = decrypt(toSend, self.server_private_key)
+            self.search_index.add(message["username"], toSend)
+            message["message"] = toSend
+            socket.emit('message_received', message, to=self.room)
+
+        if message["type"] == "MEDIA_MESSAGE":
+            # Older servers send the whole file in a single frame
+            message.update({
+                "type": "MEDIA_CHUNK",
+                "transfer_id": uuid.uuid4().hex,
+                "seq": 0,
+                "total": 1,
+                "size": len(message["message"]),
+            })
+
+        if message["type"] == "MEDIA_CHUNK":
+            self.receive_media_chunk(message)
+
+    async def abandon(self):
+        """
+        Drops the subscription after its connection failed for good, and
+        tells its browser users to join again.
+        """
+        self.discard_media_transfers()
+        if subscriptions.get(self.room) is self:
+            del subscriptions[self.room]
+
+        members = list(self.users.items()) + list(self.joining.items())
+        self.users.clear()
+        self.joining.clear()
+        self.leaving.clear()
+        for username, sid in members:
+            sessions.pop(sid, None)
+            socket.server.leave_room(sid, self.room, namespace='/')
+            emit_unavailable(sid, username, self.room)
+
+        self.search_index.save()
+        try:
+            # Without a leave the server holds the names for a resume
+            for username, _ in members:
+                await self.send_leave(username)
+            await self.disconnect()
+        except Exception as e:
+            print(f"Error disconnecting from room {self.room}: {e}")
+
+    async def get_peer_key(self, username, requester):
+        """
+        Returns the public key of a room member, asking the server for it
+        the first time.
+
+        Args:
+            username (str): The username of the room member.
+            requester (str): The username of the local user asking for it.
+
+        Returns:
+            rsa.PublicKey: The member's public key, or None if they are not in the room.
+        """
+        if username not in self.peer_keys:
+            future = self.key_requests.get(username)
+            if future is None:
+                future = asyncio.get_running_loop().create_future()
+                self.key_requests[username] = future
+                await self.send_message({
+                    "type": "PUBLIC_KEY_REQUEST",
+                    "username": requester,
+                    "room": self.room,
+                    "recipient": username
+                })
+
+            try:
+                pem = await asyncio.wait_for(
+                    asyncio.shield(future), KEY_REQUEST_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                self.key_requests.pop(username, None)
+                return None
+
+            if not pem:
+                return None
+            self.peer_keys[username] = rsa.PublicKey.load_pkcs1(pem.encode())
+
+        return self.peer_keys[username]
+
+    async def joined(self, message):
+        """
+        Completes a browser user's join once the server accepted it.
+
+        Args:
+            message (dict): The server's join response.
+        """
+        username = message["username"]
+        sid = self.joining.pop(username, None)
+        if sid is None:
+            if username in self.leaving:
+                # The user left before the server accepted the join
+                self.leaving.remove(username)
+                await self.send_leave(username)
+                await self.close_if_unused()
+            return
+
+        if self.reload_keys or not self.server_private_key:
+            # Decrypt and load the room's public and private keys
+            self.reload_keys = False
+            pub_key = bytes.fromhex(message["public_key"])
+            self.server_public_key = rsa.PublicKey.load_pkcs1(
+                decrypt(pub_key, private_key)
+            )
+
+            pri_key = bytes.fromhex(message["private_key"])
+            self.server_private_key = rsa.PrivateKey.load_pkcs1(
+                decrypt(pri_key, private_key)
+            )
+
+        self.users[username] = sid
+        # Searches only reach messages the user could have seen, rejoins
+        # after a lost connection keep the original time
+        self.joined_at.setdefault(username, time.time())
+        self.tickets[username] = message.pop("ticket")
+        try:
+            socket.server.enter_room(sid, self.room, namespace='/')
+        except ValueError:
+            # The browser already disconnected, its leave follows
+            pass
+
+        # The server does not echo joins back to the connection they came
+        # from, so announce them to the other local users here
+        socket.emit('message_received', {
+            "type": "SYSTEM_MESSAGE",
+            "color": "green",
+            "message": f"{username} has joined the chat room.",
+            "code": 200
+        }, to=self.room, skip_sid=sid)
+
+        message.pop("public_key")
+        message.pop("private_key")
+        socket.emit('message_received', message, to=sid)
+
+    def receive_media_chunk(self, message):
+        """
+        Hands a received media chunk to its writer's executor without waiting
+        for it to be written, so chat delivery continues during large
+        transfers.
+
+        Args:
+            message (dict): The MEDIA_CHUNK message.
+        """
+        loop = asyncio.get_running_loop()
+        transfer_id = message["transfer_id"]
+
+        if self.media_target(message) is None:
+            # The recipient of a direct transfer is not (or no longer) here
+            writer = self.media_transfers.pop(transfer_id, None)
+            if writer:
+                loop.run_in_executor(writer.executor, writer.discard)
+            return
+
+        if message["seq"] == 0:
+            if message.get("recipient"):
+                # Direct transfers are encrypted for the bridge's public key
+                writer = MediaWriter(
+                    message.get("filename"),
+                    direct_media_size(
+                        message["size"], rsa.common.byte_size(private_key.n)
+                    ),
+                    partial(decrypt, private_key=private_key)
+                )
+            else:
+                writer = MediaWriter(
+                    message.get("filename"), message["size"] // 2
+                )
+            self.media_transfers[transfer_id] = writer
+            print(
+                f"Receiving {writer.filename} from {message['username']}..."
+            )
+            loop.run_in_executor(writer.executor, writer.open)
+
+        writer = self.media_transfers.get(transfer_id)
+        if writer is None:
+            # The transfer started before we joined the room
+            return
+
+        written = loop.run_in_executor(
+            writer.executor, writer.write, message["message"]
+        )
+        if writer.size >= PROGRESS_MIN_SIZE:
+            written.add_done_callback(
+                lambda _: self.media_progress(writer, message)
+            )
+
+        if message["seq"] + 1 == message["total"]:
+            del self.media_transfers[transfer_id]
+            saved = loop.run_in_executor(writer.executor, writer.finish)
+            saved.add_done_callback(
+                lambda future: self.media_saved(writer, message, future)
+            )
+
+    def discard_media_transfers(self):
+        """
+        Removes the temporary files of transfers cut off by a lost connection,
+        their remaining chunks will not arrive on the next one.
+        """
+        loop = asyncio.get_running_loop()
+        for writer in self.media_transfers.values():
+            print(f"Transfer of {writer.filename} was interrupted")
+            loop.run_in_executor(writer.executor, writer.discard)
+        self.media_transfers.clear()
+
+    def media_progress(self, writer, message):
+        """
+        Reports the progress of a large media transfer.
+
+        Args:
+            writer (MediaWriter): The writer of the transfer.
+            message (dict): The latest MEDIA_CHUNK message of the transfer.
+        """
+        percent = writer.report_progress()
+        target = self.media_target(message)
+        if percent is None or target is None:
+            return
+
+        socket.emit('media_progress', {
+            "username": message["username"],
+            "filename": writer.filename,
+            "percent": percent
+        }, to=target)
+
+    def media_saved(self, writer, message, future):
+        """
+        Reports the outcome of a media transfer once it has been written.
+
+        Args:
+            writer (MediaWriter): The writer of the transfer.
+            message (dict): The last MEDIA_CHUNK message of the transfer.
+            future (asyncio.Future): The future of MediaWriter.finish.
+        """
+        error = future.exception()
+        if error:
+            print(f"Error saving {writer.filename}: {error}")
+            return
+
+        target = self.media_target(message)
+        if target is None:
+            # The recipient of a direct transfer left, emitting to None
+            # would reach every browser
+            return
+
+        socket.emit('message_received', {
+            "type": "MEDIA_MESSAGE",
+            "color": message["color"],
+            "username": message["username"],
+            "filename": writer.filename,
+            "message": f"[MEDIA] {writer.filename} saved to {writer.path}",
+            "code": 200
+        }, to=target)
+
+    def media_target(self, message):
+        """
+        Returns who media events of a transfer are emitted to.
+
+        Args:
+            message (dict): A MEDIA_CHUNK message of the transfer.
+
+        Returns:
+            str: The recipient's session id for direct transfers, otherwise the room. None if the recipient left.
+        """
+        if message.get("recipient"):
+            return self.users.get(message["recipient"])
+        return self.room
+
     async def disconnect(self):
         """
-        Disconnects the client from the chat server.
+        Disconnects the subscription from the chat server.
         """
         print("Disconnecting...")
         await self.websocket.close()
 
 
+def emit_too_large(sid, filename, limit):
+    """
+    Tells a browser user that a message is too large to be sent.
+
+    Args:
+        sid (str): The Socket.IO session id of the browser user.
+        filename (str): The name of the file, or None for a text message.
+        limit (str): The size limit, as shown to the user.
+    """
+    socket.emit('message_received', {
+        "type": "SYSTEM_MESSAGE",
+        "color": "red",
+        "message": f"[ERROR] {filename or 'The message'} is too large, {limit}.",
+        "code": 413
+    }, to=sid)
+
+
+def emit_unavailable(sid, username, room):
+    """
+    Tells a browser user that the chat server could not be reached.
+
+    Args:
+        sid (str): The Socket.IO session id of the browser user.
+        username (str): The username of the browser user.
+        room (str): The chat room the user tried to be in.
+    """
+    socket.emit('message_received', {
+        "type": "SYSTEM_MESSAGE",
+        "color": "red",
+        "message": "[ERROR] Could not connect to the chat server. Please try again.",
+        "code": 503,
+        "username": username,
+        "room": room
+    }, to=sid)
+
+
+async def join_room_upstream(room, username, sid):
+    """
+    Joins a browser user to a chat room, subscribing the bridge to the room
+    first if none of its users are in it yet.
+
+    Args:
+        room (str): The chat room to join.
+        username (str): The username of the browser user.
+        sid (str): The Socket.IO session id of the browser user.
+    """
+    subscription = subscriptions.get(room)
+    if subscription is None:
+        subscription = RoomSubscription(HOST, PORT, room)
+        subscriptions[room] = subscription
+
+    await subscription.join(username, sid)
+
+
+async def send_upstream(room, message):
+    """
+    Sends a message to a chat room through the bridge's subscription.
+
+    Args:
+        room (str): The chat room to send the message to.
+        message (dict): The message to be sent.
+    """
+    await subscriptions[room].send_message(message)
+
+
+async def leave_room_upstream(room, username, sid):
+    """
+    Removes a browser user from a chat room.
+
+    Args:
+        room (str): The chat room to leave.
+        username (str): The username of the browser user.
+        sid (str): The Socket.IO session id of the browser user.
+    """
+    subscription = subscriptions.get(room)
+    if subscription:
+        await subscription.leave(username, sid)
+
+
+def run_upstream(coroutine):
+    """
+    Schedules a coroutine on the upstream event loop without waiting for it.
+
+    Args:
+        coroutine (coroutine): The coroutine to be run.
+
+    Returns:
+        concurrent.futures.Future: The future of the coroutine.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, upstream_loop)
+
+
 @app.route('/')
 def home():
     """
@@ -213,21 +794,12 @@ def handle_join(data):
     Args:
         data (dict): The data containing username and room information.
     """
-    global clients
-
     username = data['username']
     room = data['room']
     print(f"Joining room {room} as {username}...")
 
-    client = ChatClient(HOST, PORT, username, room)
-
-    if room in clients:
-        if username not in clients[room]:
-            clients[room][username] = client
-    else:
-        clients[room] = {username: client}
-
-    asyncio.run(client.connect_to_server())
+    sessions[request.sid] = (room, username)
+    run_upstream(join_room_upstream(room, username, request.sid))
 
 
 @socket.on('send_message')
@@ -238,18 +810,22 @@ def handle_message(data):
     Args:
         data (dict): The data containing message, room, and username information.
     """
-    global clients
-
     print(data)
     message = data['message']
     room = data['room']
     username = data['username']
 
-    client = clients[room][username]
+    subscription = subscriptions.get(room)
+    if subscription is None or username not in subscription.users:
+        return
 
     type = "CHAT_MESSAGE"
     filename = None
 
+    if message.startswith("/dm"):
+        send_direct_message(subscription, username, message, request.sid)
+        return
+
     if message.startswith("/media"):
         # Handle media message
         try:
@@ -263,24 +839,153 @@ def handle_message(data):
             return
 
     encrypted_message = (
-        encrypt(message, server_public_key)
+        encrypt(message, subscription.server_public_key)
         if type == "CHAT_MESSAGE" else file_content
     )
 
     msg = {
         "type": type,
-        "username": client.username,
-        "room": client.room,
+        "username": username,
+        "room": room,
         "message": encrypted_message.hex(),
         "code": 200,
         "filename": filename
     }
+    # An oversized frame would close the room's shared connection
+    if not fits_in_frame(msg):
+        emit_too_large(request.sid, filename, "files must be under 512 KB")
+        return
+
+    run_upstream(send_upstream(room, msg))
+    if type == "CHAT_MESSAGE":
+        subscription.search_index.add(username, message)
+
+    # The server does not echo messages back to the connection they came
+    # from, so deliver them to the other local users here
+    socket.emit('message_received', {
+        "type": "USER_MESSAGE" if type == "CHAT_MESSAGE" else type,
+        "color": "blue",
+        "username": username,
+        "message": message if type == "CHAT_MESSAGE" else f"[MEDIA] {filename}",
+        "code": 200
+    }, to=room, skip_sid=request.sid)
+
+
+def send_direct_message(subscription, username, command, sid):
+    """
+    Sends a message or file from a browser user to a single member of the
+    room, encrypted with that member's public key.
+
+    Args:
+        subscription (RoomSubscription): The subscription of the user's room.
+        username (str): The username of the sender.
+        command (str): The command, '/dm <username> <message>' or '/dm <username> /media <path>'.
+        sid (str): The Socket.IO session id of the sender.
+    """
+    parts = command.split(maxsplit=2)
+    if len(parts) < 3:
+        return
+
+    recipient, message = parts[1], parts[2]
+    recipient_key = run_upstream(
+        subscription.get_peer_key(recipient, username)
+    ).result()
+    if recipient_key is None:
+        socket.emit('message_received', {
+            "type": "SYSTEM_MESSAGE",
+            "color": "red",
+            "message": f"[ERROR] {recipient} is not in the chat room.",
+            "code": 404
+        }, to=sid)
+        return
+
+    filename = None
+    if message.startswith("/media"):
+        try:
+            with open(message.split(maxsplit=1)[1], "rb") as file:
+                file_content = file.read()
+            filename = os.path.basename(message.split(maxsplit=1)[1])
+            print(f"Sending {filename} to {recipient}...")
+        except Exception as e:
+            print(f"Error reading file: {e}")
+            return
+        # Files are hex encoded so they can go through the text encryption
+        message = file_content.hex()
+
+    msg = {
+        "type": "DIRECT_MESSAGE",
+        "username": username,
+        "room": subscription.room,
+        "recipient": recipient,
+        "message": encrypt(message, recipient_key).hex(),
+        "code": 200,
+        "filename": filename
+    }
+    # An oversized frame would close the room's shared connection
+    if not fits_in_frame(msg):
+        emit_too_large(sid, filename, "direct files must be under about 240 KB")
+        return
+    run_upstream(send_upstream(subscription.room, msg))
+
+
+@socket.on('search')
+def handle_search(data):
+    """
+    Handles a client searching the history of its chat room. Only
+    messages sent since the user joined are searched.
+
+    Args:
+        data (dict): The data containing room, username and query information.
+    """
+    room = data['room']
+    username = data['username']
+    query = data['query']
+
+    subscription = subscriptions.get(room)
+    if (
+        sessions.get(request.sid) != (room, username)
+        or subscription is None
+        or subscription.users.get(username) != request.sid
+    ):
+        socket.emit('message_received', {
+            "type": "SYSTEM_MESSAGE",
+            "color": "red",
+            "message": "[ERROR] You are not in the chat room.",
+            "code": 403,
+            "username": username,
+            "room": room
+        }, to=request.sid)
+        return
+
+    hits = subscription.search_index.search(
+        query, since=subscription.joined_at.get(username)
+    )
 
-    asyncio.run(
-        client.send_message(msg)
+    results = [
+        {
+            "score": score,
+            "time": timestamp,
+            "username": username,
+            "message": text
+        }
+        for score, timestamp, username, text in hits
+    ]
+    socket.emit(
+        'search_results', {"query": query, "results": results},
+        to=request.sid
     )
 
 
+@socket.on('disconnect')
+def handle_disconnect():
+    """
+    Handles a browser closing its Socket.IO connection.
+    """
+    session = sessions.pop(request.sid, None)
+    if session:
+        run_upstream(leave_room_upstream(*session, request.sid))
+
+
 @app.route('/user_disconnect', methods=['POST'])
 def user_disconnect():
     """
@@ -289,21 +994,21 @@ def user_disconnect():
     Returns:
         Response: A JSON response indicating the success of the operation.
     """
-    global clients
-
     data = request.get_json()
+    data = data.get('data', data)
     room = data['room']
     username = data['username']
 
-    client = clients[room][username]
-    msg = {
-        "type": "LEAVE_ROOM",
-        "username": client.username,
-        "room": client.room,
-        "code": 400
-    }
-    asyncio.run(client.send_message(msg))
-    del clients[room][username]
+    subscription = subscriptions.get(room)
+    sid = None
+    if subscription:
+        sid = (
+            subscription.users.get(username)
+            or subscription.joining.get(username)
+        )
+    if sid:
+        sessions.pop(sid, None)
+        run_upstream(leave_room_upstream(room, username, sid))
     return jsonify({'message': 'Data received successfully'})
 
 
@@ -311,4 +1016,8 @@ if __name__ == "__main__":
     HOST = '45.90.12.30'  # Server IP address
     PORT = 7081  # Server port
 
-    socket.run(app, debug=True, host='0.0.0.0', port=6652)
\ No newline at end of file
+    try:
+        socket.run(app, debug=True, host='0.0.0.0', port=6652)
+    finally:
+        for subscription in list(subscriptions.values()):
+            subscription.search_index.save()
\ No newline at end of file
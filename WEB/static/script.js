@@ -8,12 +8,25 @@ let connected = false;
 let username;
 let room;
 
+const MAX_RENDERED_MESSAGES = 200; // Messages kept in the DOM at once
+const HISTORY_PAGE_SIZE = 50; // Messages paged in when scrolling to an edge
+const MAX_HISTORY_MESSAGES = 10000; // Messages kept in memory for paging
+const SCROLL_EDGE = 40; // Distance in pixels that counts as reaching an edge
+
+const chatView = createChatView(document.getElementById('chat-messages'));
+
 /**
  * Sends a message via WebSocket.
  * 
  * @param {string} message - The message to be sent.
  */
 function sendMessage(message) {
+    if (message.startsWith('/search')) {
+        // Search the room history kept by the bridge instead of sending
+        socket.emit('search', { room: room, username: username, query: message.slice('/search'.length).trim() });
+        return;
+    }
+
     let data = { room: room, username: username, message: message };
     console.log(data);
     socket.emit('send_message', data);
@@ -32,6 +45,9 @@ function initializeWebSocket(newUsername, newRoom) {
         username = newUsername;
         room = newRoom;
 
+        // A previous attempt may have failed, this one starts afresh
+        is409Error = false;
+
         // Emit the 'join' event with updated data
         let data = { room: room, username: username };
         socket.emit('join', data);
@@ -69,20 +85,19 @@ function startReadingInput() {
 }
 
 /**
- * Updates the chat with a new message.
+ * Creates the DOM nodes for a chat message.
  * 
- * @param {string} message - The message to be displayed.
- * @param {string} type - The type of message ('SYSTEM_MESSAGE', 'YOU', 'OTHERS').
+ * @param {Object} entry - The message entry ({ message, type }).
+ * @returns {HTMLElement} The message container.
  */
-function updateChat(message, type) {
-    const chatMessages = document.getElementById('chat-messages');
+function createMessageElement(entry) {
     const messageContainer = document.createElement('div');
     const messageElement = document.createElement('div');
 
-    if (type === 'SYSTEM_MESSAGE') {
+    if (entry.type === 'SYSTEM_MESSAGE') {
         // Message is a system message (e.g., [INFO], [ERROR], [JOIN], [LEAVE])
         messageContainer.classList.add('message', 'system');
-    } else if (type === 'YOU') {
+    } else if (entry.type === 'YOU') {
         // Message is sent by the current user
         messageContainer.classList.add('message', 'sender-container');
         messageElement.classList.add('message', 'sender');
@@ -93,14 +108,269 @@ function updateChat(message, type) {
     }
     messageElement.style.whiteSpace = 'pre-wrap';
 
-    messageElement.textContent = message;
+    messageElement.textContent = entry.message;
 
     // Append message to message container
     messageContainer.appendChild(messageElement);
-    // Append message container to chat container
-    chatMessages.appendChild(messageContainer);
-    // Scroll to the bottom of the chat container
-    chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageContainer;
+}
+
+/**
+ * Creates the state of a chat view: the element its messages are rendered
+ * into and the history they are paged in from.
+ * 
+ * @param {HTMLElement} container - The element the messages are rendered into.
+ * @returns {Object} The view state.
+ */
+function createChatView(container) {
+    return {
+        container: container,
+        history: [], // Every message still available for paging
+        pending: [], // Messages waiting for the next animation frame
+        flushScheduled: false,
+        renderStart: 0, // Index in history of the first rendered message
+        renderEnd: 0 // Index in history after the last rendered message
+    };
+}
+
+/**
+ * Builds a fragment with the DOM nodes of view.history[start:end].
+ * 
+ * @param {Object} view - The chat view.
+ * @param {number} start - Index of the first message.
+ * @param {number} end - Index after the last message.
+ * @returns {DocumentFragment} The rendered messages.
+ */
+function renderRange(view, start, end) {
+    const fragment = document.createDocumentFragment();
+    for (let i = start; i < end; i++) {
+        fragment.appendChild(createMessageElement(view.history[i]));
+    }
+    return fragment;
+}
+
+/**
+ * Checks whether a chat view is scrolled to (or near) the bottom.
+ * 
+ * @param {HTMLElement} container - The element the messages are rendered into.
+ * @returns {boolean} True if the newest messages are in view.
+ */
+function isNearBottom(container) {
+    return container.scrollHeight - container.scrollTop - container.clientHeight < SCROLL_EDGE;
+}
+
+/**
+ * Removes rendered messages from the top of a chat view.
+ * 
+ * @param {Object} view - The chat view.
+ * @param {number} count - The number of messages to remove.
+ */
+function dropFromTop(view, count) {
+    for (let i = 0; i < count; i++) {
+        view.container.removeChild(view.container.firstChild);
+    }
+    view.renderStart += count;
+}
+
+/**
+ * Removes rendered messages from the bottom of a chat view.
+ * 
+ * @param {Object} view - The chat view.
+ * @param {number} count - The number of messages to remove.
+ */
+function dropFromBottom(view, count) {
+    for (let i = 0; i < count; i++) {
+        view.container.removeChild(view.container.lastChild);
+    }
+    view.renderEnd -= count;
+}
+
+/**
+ * Updates the chat with a new message.
+ * 
+ * @param {string} message - The message to be displayed.
+ * @param {string} type - The type of message ('SYSTEM_MESSAGE', 'YOU', 'OTHERS').
+ */
+function updateChat(message, type) {
+    queueMessage(chatView, message, type);
+}
+
+/**
+ * Adds a message to a chat view. Messages are buffered and rendered
+ * together on the next animation frame.
+ * 
+ * @param {Object} view - The chat view.
+ * @param {string} message - The message to be displayed.
+ * @param {string} type - The type of message ('SYSTEM_MESSAGE', 'YOU', 'OTHERS').
+ */
+function queueMessage(view, message, type) {
+    view.pending.push({ message: message, type: type });
+
+    if (!view.flushScheduled) {
+        view.flushScheduled = true;
+        requestAnimationFrame(() => flushMessages(view));
+    }
+}
+
+/**
+ * Moves buffered messages into the history and renders them if the newest
+ * messages are in view, keeping at most MAX_RENDERED_MESSAGES in the DOM.
+ * 
+ * @param {Object} view - The chat view.
+ */
+function flushMessages(view) {
+    const container = view.container;
+    const following = view.renderEnd === view.history.length && isNearBottom(container);
+
+    view.flushScheduled = false;
+    for (const entry of view.pending) {
+        view.history.push(entry);
+    }
+    view.pending = [];
+
+    // Forget the oldest messages once the history grows past its limit
+    const excess = view.history.length - MAX_HISTORY_MESSAGES;
+    if (excess >= HISTORY_PAGE_SIZE) {
+        view.history.splice(0, excess);
+        if (view.renderStart < excess) {
+            dropFromTop(view, Math.min(excess - view.renderStart, view.renderEnd - view.renderStart));
+        }
+        view.renderStart = Math.max(view.renderStart - excess, 0);
+        view.renderEnd = Math.max(view.renderEnd - excess, 0);
+    }
+
+    // New messages are picked up by the scroll handler while reading history
+    if (!following) {
+        return;
+    }
+
+    if (view.history.length - view.renderEnd >= MAX_RENDERED_MESSAGES) {
+        // Too many new messages to keep any of the current window
+        container.replaceChildren();
+        view.renderStart = view.renderEnd = view.history.length - MAX_RENDERED_MESSAGES;
+    }
+
+    container.appendChild(renderRange(view, view.renderEnd, view.history.length));
+    view.renderEnd = view.history.length;
+
+    const overflow = view.renderEnd - view.renderStart - MAX_RENDERED_MESSAGES;
+    if (overflow > 0) {
+        dropFromTop(view, overflow);
+    }
+
+    // Scroll to the bottom of the chat container, once per frame
+    container.scrollTop = container.scrollHeight;
+}
+
+/**
+ * Pages older or newer history into a chat view when scrolling near its edges.
+ * 
+ * @param {Object} view - The chat view.
+ */
+function handleChatScroll(view) {
+    const container = view.container;
+
+    if (container.scrollTop < SCROLL_EDGE && view.renderStart > 0) {
+        // Page in older messages above, keeping the visible ones in place
+        const start = Math.max(0, view.renderStart - HISTORY_PAGE_SIZE);
+        const previousHeight = container.scrollHeight;
+
+        container.insertBefore(renderRange(view, start, view.renderStart), container.firstChild);
+        view.renderStart = start;
+        container.scrollTop += container.scrollHeight - previousHeight;
+
+        const overflow = view.renderEnd - view.renderStart - MAX_RENDERED_MESSAGES;
+        if (overflow > 0) {
+            dropFromBottom(view, overflow);
+        }
+    } else if (isNearBottom(container) && view.renderEnd < view.history.length) {
+        // Page in newer messages below
+        const end = Math.min(view.history.length, view.renderEnd + HISTORY_PAGE_SIZE);
+
+        container.appendChild(renderRange(view, view.renderEnd, end));
+        view.renderEnd = end;
+
+        const overflow = view.renderEnd - view.renderStart - MAX_RENDERED_MESSAGES;
+        if (overflow > 0) {
+            const previousHeight = container.scrollHeight;
+            dropFromTop(view, overflow);
+            container.scrollTop -= previousHeight - container.scrollHeight;
+        }
+    }
+}
+
+chatView.container.addEventListener('scroll', () => handleChatScroll(chatView), { passive: true });
+
+/**
+ * Measures frame times while rendering a synthetic burst of messages.
+ * 
+ * The burst goes to a separate off-screen view with its own history, so
+ * the chat and its history are left untouched. Run from the browser
+ * console, e.g. `benchmarkChatBurst(10000)` and
+ * `benchmarkChatBurst(10000, true)` to compare with appending every
+ * message directly and scrolling after each one.
+ * 
+ * @param {number} count - The number of messages in the burst.
+ * @param {boolean} unbatched - Render every message immediately instead of batching.
+ * @returns {Promise<Object>} Frame time statistics in milliseconds.
+ */
+function benchmarkChatBurst(count = 10000, unbatched = false) {
+    // Same size as the chat, but out of sight, so layout is still measured
+    const container = document.createElement('div');
+    container.style.position = 'absolute';
+    container.style.left = '-10000px';
+    container.style.overflowY = 'auto';
+    container.style.width = `${chatView.container.clientWidth || 600}px`;
+    container.style.height = `${chatView.container.clientHeight || 400}px`;
+    document.body.appendChild(container);
+    const view = createChatView(container);
+
+    const frames = [];
+    const started = performance.now();
+    let last = started;
+
+    return new Promise(resolve => {
+        function onFrame(now) {
+            frames.push(now - last);
+            last = now;
+            if (now - started < 2000) {
+                requestAnimationFrame(onFrame);
+                return;
+            }
+
+            const sorted = frames.slice().sort((a, b) => a - b);
+            const stats = {
+                frames: frames.length,
+                mean: frames.reduce((sum, value) => sum + value, 0) / frames.length,
+                p95: sorted[Math.floor(sorted.length * 0.95)],
+                max: sorted[sorted.length - 1],
+                over50ms: frames.filter(value => value > 50).length,
+                rendered: container.childElementCount
+            };
+            container.remove();
+            console.table(stats);
+            resolve(stats);
+        }
+        requestAnimationFrame(onFrame);
+
+        // Deliver the burst in 100 message batches, as socket events would arrive
+        let sent = 0;
+        function sendBatch() {
+            for (let i = 0; i < 100 && sent < count; i++, sent++) {
+                const message = `bench: synthetic message ${sent}`;
+                if (unbatched) {
+                    container.appendChild(createMessageElement({ message: message, type: 'OTHERS' }));
+                    container.scrollTop = container.scrollHeight;
+                } else {
+                    queueMessage(view, message, 'OTHERS');
+                }
+            }
+            if (sent < count) {
+                setTimeout(sendBatch, 0);
+            }
+        }
+        sendBatch();
+    });
 }
 
 // Event listener for submitting the username and room
@@ -114,7 +384,7 @@ document.getElementById('login-form').addEventListener('submit', function (event
 // Event listener for receiving messages from the server
 socket.on('message_received', function (data) {
     if (data.type === 'SYSTEM_MESSAGE') {
-        if (data.code === 409) {
+        if (data.code === 409 || data.code === 503) {
             is409Error = true; // Set is409Error to true if it's a 409 error
 
             const notificationMessage = document.getElementById('notification-message');
@@ -137,11 +407,36 @@ socket.on('message_received', function (data) {
             firstRun = false; // Update firstRun to false after the first run
             startReadingInput(data.room, data.username);
         }
+    } else if (data.type === 'DIRECT_MESSAGE') {
+        updateChat(`[DM] ${data.username}: ${data.message}`, 'OTHERS');
     } else {
         updateChat(`${data.username}: ${data.message}`, 'OTHERS');
     }
 });
 
+// Event listener for results of a /search command
+socket.on('search_results', function (data) {
+    updateChat(`${data.results.length} results for '${data.query}'`, 'SYSTEM_MESSAGE');
+    for (const hit of data.results) {
+        const sent = new Date(hit.time * 1000).toLocaleString();
+        updateChat(`[${sent}] ${hit.username}: ${hit.message}`, 'SYSTEM_MESSAGE');
+    }
+});
+
+// Event listener for progress of large incoming media files
+socket.on('media_progress', function (data) {
+    const notificationMessage = document.getElementById('notification-message');
+    notificationMessage.textContent = `Receiving ${data.filename} from ${data.username}: ${data.percent}%`;
+    notification.classList.remove('hidden');
+
+    // Hide the notification unless another progress update replaces it
+    clearTimeout(notification.hideTimeout);
+    notification.hideTimeout = setTimeout(() => {
+        notificationMessage.textContent = '';
+        notification.classList.add('hidden');
+    }, 5000);
+});
+
 // Event listener for handling user disconnect
 window.addEventListener('beforeunload', function (event) {
     userDisconnect();
@@ -0,0 +1,340 @@
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import sys
+import time
+import rsa
+from client import encrypt, decrypt
+from server import split_media_message
+
+# Payload sizes in bytes
+MESSAGE_SIZES = [1, 1024, 64 * 1024, 1024 * 1024]
+KEY_SIZES = [1024, 2048]
+
+# Repetitions needed for a spread at all, and for rejecting outliers by IQR
+MIN_REPETITIONS = 3
+MIN_OUTLIER_SAMPLES = 5
+
+
+def measure(function, warmup, repetitions, min_time, max_time):
+    """
+    Times a function and returns robust statistics of the time per call.
+
+    Each repetition runs the function enough times to take at least
+    min_time seconds. The warmup counts toward the max_time budget, and slow
+    functions get fewer repetitions, but never less than MIN_REPETITIONS. A
+    benchmark takes about max_time seconds unless a few calls of it already
+    take longer. With at least MIN_OUTLIER_SAMPLES repetitions, outliers
+    outside 1.5 times the interquartile range are dropped.
+
+    Args:
+        function (callable): The function to be timed, called without arguments.
+        warmup (int): The number of untimed calls before measuring.
+        repetitions (int): The number of timed repetitions, at least MIN_REPETITIONS.
+        min_time (float): The minimum duration of a repetition in seconds.
+        max_time (float): The time budget of the benchmark in seconds, warmup included.
+
+    Returns:
+        dict: The median, mean, stdev, min and max seconds per call and the number of kept and rejected repetitions.
+    """
+    budget_started = time.perf_counter()
+    for _ in range(warmup):
+        function()
+        if time.perf_counter() - budget_started >= max_time:
+            break
+
+    # Calibrate the number of calls per repetition
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+    # The calibration run is the first repetition
+    remaining = max_time - (time.perf_counter() - budget_started)
+    repetitions = max(
+        MIN_REPETITIONS, min(repetitions, 1 + int(remaining / elapsed))
+    )
+    samples = [elapsed / loops]
+    for _ in range(repetitions - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            function()
+        samples.append((time.perf_counter() - started) / loops)
+
+    samples.sort()
+    kept = samples
+    if len(samples) >= MIN_OUTLIER_SAMPLES:
+        q1, _, q3 = statistics.quantiles(samples, n=4)
+        spread = 1.5 * (q3 - q1)
+        kept = [
+            value for value in samples if q1 - spread <= value <= q3 + spread
+        ]
+
+    return {
+        "median": statistics.median(kept),
+        "mean": statistics.fmean(kept),
+        "stdev": statistics.stdev(kept) if len(kept) > 1 else 0.0,
+        "min": kept[0],
+        "max": kept[-1],
+        "loops": loops,
+        "repetitions": len(kept),
+        "rejected": len(samples) - len(kept),
+    }
+
+
+def format_size(size):
+    """
+    Formats a size in bytes for benchmark names.
+
+    Args:
+        size (int): The size in bytes.
+
+    Returns:
+        str: The size, e.g. '1B', '64KB' or '1MB'.
+    """
+    for unit, factor in (("MB", 1024 * 1024), ("KB", 1024)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return f"{size}B"
+
+
+def collect_benchmarks(key_sizes, sizes):
+    """
+    Builds the benchmarks to be run.
+
+    Args:
+        key_sizes (list): The RSA key sizes in bits.
+        sizes (list): The payload sizes in bytes.
+
+    Returns:
+        dict: The functions to be timed, keyed by benchmark name.
+    """
+    benchmarks = {}
+
+    for bits in key_sizes:
+        print(f"Generating {bits} bit keys...", file=sys.stderr)
+        (public_key, private_key) = rsa.newkeys(bits)
+        public_pem = public_key.save_pkcs1("PEM")
+        private_pem = private_key.save_pkcs1("PEM")
+
+        benchmarks[f"pem/save_public/{bits}"] = (
+            lambda key=public_key: key.save_pkcs1("PEM")
+        )
+        benchmarks[f"pem/save_private/{bits}"] = (
+            lambda key=private_key: key.save_pkcs1("PEM")
+        )
+        benchmarks[f"pem/load_public/{bits}"] = (
+            lambda pem=public_pem: rsa.PublicKey.load_pkcs1(pem)
+        )
+        benchmarks[f"pem/load_private/{bits}"] = (
+            lambda pem=private_pem: rsa.PrivateKey.load_pkcs1(pem)
+        )
+
+        for size in sizes:
+            message = "x" * size
+            encrypted = encrypt(message, public_key)
+            name = f"{bits}/{format_size(size)}"
+
+            benchmarks[f"encrypt/{name}"] = (
+                lambda message=message, key=public_key: encrypt(message, key)
+            )
+            benchmarks[f"decrypt/{name}"] = (
+                lambda encrypted=encrypted, key=private_key:
+                    decrypt(encrypted, key)
+            )
+
+    for size in sizes:
+        payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+        encoded = payload.hex()
+        name = format_size(size)
+        envelope = {
+            "type": "CHAT_MESSAGE",
+            "username": "benchmark",
+            "room": "benchmark",
+            "message": encoded,
+            "code": 200,
+            "filename": None
+        }
+        serialized = json.dumps(envelope)
+        header = json.dumps({**envelope, "message": None}).encode()
+
+        benchmarks[f"hex/encode/{name}"] = lambda payload=payload: payload.hex()
+        benchmarks[f"hex/decode/{name}"] = (
+            lambda encoded=encoded: bytes.fromhex(encoded)
+        )
+        # The same envelope sent as a binary frame: JSON header + raw bytes
+        benchmarks[f"binary/encode/{name}"] = (
+            lambda header=header, payload=payload:
+                len(header).to_bytes(4, "big") + header + payload
+        )
+        frame = len(header).to_bytes(4, "big") + header + payload
+        benchmarks[f"binary/decode/{name}"] = (
+            lambda frame=frame: (
+                json.loads(frame[4:4 + int.from_bytes(frame[:4], "big")]),
+                frame[4 + int.from_bytes(frame[:4], "big"):]
+            )
+        )
+        benchmarks[f"envelope/dumps/{name}"] = (
+            lambda envelope=envelope: json.dumps(envelope)
+        )
+        benchmarks[f"envelope/loads/{name}"] = (
+            lambda serialized=serialized: json.loads(serialized)
+        )
+        benchmarks[f"envelope/split_media/{name}"] = (
+            lambda envelope=envelope: split_media_message(envelope)
+        )
+
+    return benchmarks
+
+
+def run(args):
+    """
+    Runs the benchmarks and writes the results to a JSON file.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        int: The exit code.
+    """
+    sizes = [size for size in MESSAGE_SIZES if size <= args.max_size]
+    benchmarks = collect_benchmarks(args.key_sizes, sizes)
+
+    results = {}
+    for name, function in benchmarks.items():
+        if args.filter and args.filter not in name:
+            continue
+
+        stats = measure(
+            function, args.warmup, args.repetitions,
+            args.min_time, args.max_time
+        )
+        results[name] = stats
+        print(
+            f"{name:<32} {stats['median'] * 1e6:>14.2f} us"
+            f"  ±{stats['stdev'] * 1e6:.2f}"
+            f"  ({stats['repetitions']} kept, {stats['rejected']} rejected)"
+        )
+
+    output = {
+        "meta": {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rsa": rsa.__version__,
+        },
+        "benchmarks": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent=4)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+def compare(args):
+    """
+    Compares two result files and fails if a tracked metric regressed.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        int: 1 if any benchmark regressed beyond the threshold, otherwise 0.
+    """
+    with open(args.baseline) as file:
+        baseline = json.load(file)["benchmarks"]
+    with open(args.current) as file:
+        current = json.load(file)["benchmarks"]
+
+    regressions = []
+    for name in sorted(baseline.keys() & current.keys()):
+        before = baseline[name][args.metric]
+        after = current[name][args.metric]
+        change = (after - before) / before * 100 if before else 0.0
+
+        status = ""
+        if change > args.threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif change < -args.threshold:
+            status = "improved"
+
+        print(
+            f"{name:<32} {before * 1e6:>14.2f} us {after * 1e6:>14.2f} us"
+            f" {change:>+8.1f}% {status}"
+        )
+
+    for name in sorted(baseline.keys() - current.keys()):
+        print(f"{name:<32} missing from {args.current}")
+
+    if regressions:
+        print(
+            f"{len(regressions)} benchmarks regressed by more than "
+            f"{args.threshold}%"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the crypto and codec helpers."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.add_argument("--warmup", type=int, default=2)
+    run_parser.add_argument(
+        "--repetitions", type=int, default=15,
+        help=f"timed repetitions, at least {MIN_REPETITIONS}"
+    )
+    run_parser.add_argument(
+        "--min-time", type=float, default=0.05,
+        help="minimum seconds per repetition"
+    )
+    run_parser.add_argument(
+        "--max-time", type=float, default=10.0,
+        help="seconds per benchmark, warmup included, after which slow "
+        "benchmarks use fewer repetitions"
+    )
+    run_parser.add_argument(
+        "--key-sizes", type=int, nargs="+", default=KEY_SIZES
+    )
+    run_parser.add_argument(
+        "--max-size", type=int, default=MESSAGE_SIZES[-1],
+        help="largest payload size in bytes"
+    )
+    run_parser.add_argument(
+        "--filter", help="only run benchmarks whose name contains this"
+    )
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser(
+        "compare", help="compare results against a baseline"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=10.0,
+        help="allowed slowdown in percent"
+    )
+    compare_parser.add_argument(
+        "--metric", default="median",
+        choices=["median", "mean", "min", "max"]
+    )
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    if args.command == "run" and args.repetitions < MIN_REPETITIONS:
+        run_parser.error(
+            f"--repetitions must be at least {MIN_REPETITIONS}"
+        )
+    sys.exit(args.handler(args))
@@ -2,15 +2,32 @@ import asyncio
 import websockets
 import threading
 from colorama import Fore, Style
+import atexit
 import json
 import os
+import random
 import rsa
+import time
+import uuid
+from concurrent.futures import Future
+from functools import partial
+from storage import (
+    MediaWriter, SearchIndex, PROGRESS_MIN_SIZE, direct_media_size,
+    fits_in_frame
+)
 
 # Generate RSA keys for the client
 (public_key, private_key) = rsa.newkeys(1024)
 server_public_key = None
 server_private_key = None
 
+# Seconds to wait for the server to hand out a room member's public key
+KEY_REQUEST_TIMEOUT = 5
+
+# Reconnect delays in seconds, doubled after every failed attempt
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+
 
 def encrypt(message, public_key):
     """
@@ -89,25 +106,99 @@ class ChatClient:
         self.username = username
         self.room = room
         self.websocket = None
+        self.media_transfers = {}
+        self.search_index = SearchIndex(room)
+        self.ticket = None
+        self.peer_keys = {}
+        self.key_requests = {}
 
     async def connect_to_server(self):
         """
         Connects to the chat server and joins the specified chat room.
+
+        If the connection drops, reconnects after a growing, jittered delay
+        and presents the resumption ticket, so the cached room keys are kept
+        without a new key exchange.
         """
         uri = f"ws://{self.host}:{self.port}"
-        self.websocket = await websockets.connect(uri)
-        msg = {
+        delay = RECONNECT_DELAY
+
+        while True:
+            try:
+                self.websocket = await websockets.connect(uri)
+            except OSError as e:
+                if not self.ticket:
+                    raise
+                print(f"Error reconnecting to the server: {e}")
+            else:
+                delay = RECONNECT_DELAY
+                if self.ticket:
+                    msg = {
+                        "type": "RESUME_ROOM",
+                        "username": self.username,
+                        "room": self.room,
+                        "ticket": self.ticket
+                    }
+                else:
+                    msg = self.join_message()
+                await self.websocket.send(json.dumps(msg))
+
+                # Receive messages from the server until the connection drops
+                if not await self.receive_messages() or not self.ticket:
+                    break
+                print("Reconnecting...")
+
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def get_peer_key(self, username):
+        """
+        Returns the public key of a room member, asking the server for it
+        the first time. Must be called from outside the event loop.
+
+        Args:
+            username (str): The username of the room member.
+
+        Returns:
+            rsa.PublicKey: The member's public key, or None if they are not in the room.
+        """
+        if username not in self.peer_keys:
+            future = self.key_requests.setdefault(username, Future())
+            msg = {
+                "type": "PUBLIC_KEY_REQUEST",
+                "username": self.username,
+                "room": self.room,
+                "recipient": username
+            }
+            asyncio.run(self.send_message(msg))
+
+            try:
+                pem = future.result(timeout=KEY_REQUEST_TIMEOUT)
+            except Exception as e:
+                print(f"Error requesting public key: {e}")
+                self.key_requests.pop(username, None)
+                return None
+
+            if not pem:
+                return None
+            self.peer_keys[username] = rsa.PublicKey.load_pkcs1(pem.encode())
+
+        return self.peer_keys[username]
+
+    def join_message(self):
+        """
+        Builds the JOIN_ROOM message, which starts a full key exchange.
+
+        Returns:
+            dict: The message to be sent.
+        """
+        return {
             "type": "JOIN_ROOM",
             "username": self.username,
             "room": self.room,
             "code": 200,
             "public_key": public_key.save_pkcs1("PEM").decode()
         }
-        await self.websocket.send(json.dumps(msg))
-
-        # Start receiving messages from the server
-        receive_task = asyncio.create_task(self.receive_messages())
-        await receive_task
 
     async def send_message(self, message):
         """
@@ -121,6 +212,9 @@ class ChatClient:
     async def receive_messages(self):
         """
         Receives messages from the chat server and handles them.
+
+        Returns:
+            bool: True if the connection was lost, False on other errors.
         """
         global server_public_key, server_private_key
 
@@ -133,19 +227,30 @@ class ChatClient:
                     print(
                         f"{colors[message['color']]}{message['message']}{colors['reset']}"  # noqa
                     )
+                    if "ticket" in message:
+                        self.ticket = message["ticket"]
+
                     if message["code"] == 409:
                         # Handle username conflict
                         self.username = input("Enter a different username: ")
-                        msg = {
-                            "type": "JOIN_ROOM",
-                            "username": self.username,
-                            "room": self.room,
-                            "code": 200,
-                            "public_key": public_key.save_pkcs1("PEM").decode()
-                        }
+                        msg = self.join_message()
                         await self.websocket.send(json.dumps(msg))
                         continue
 
+                    elif message["code"] == 401:
+                        # The session could not be resumed, the room keys
+                        # may have changed so join with a new key exchange
+                        self.ticket = None
+                        server_public_key = server_private_key = None
+                        await self.websocket.send(
+                            json.dumps(self.join_message())
+                        )
+                        continue
+
+                    elif message["code"] == 400:
+                        # The member left, a new session has a new key
+                        self.peer_keys.pop(message["username"], None)
+
                     elif not server_public_key and not server_private_key:
                         # Decrypt and load server's public and private keys
                         pub_key = bytes.fromhex(message["public_key"])
@@ -162,36 +267,194 @@ class ChatClient:
                     # Decrypt and display user message
                     toSend = bytes.fromhex(message["message"])
                     toSend = decrypt(toSend, server_private_key)
+                    self.search_index.add(message["username"], toSend)
                     print(
                         f"{colors[message['color']]}{message['username']}: {toSend}{colors['reset']}"   # noqa
                     )
 
-                if message["type"] == "MEDIA_MESSAGE":
-                    # Handle incoming media message
-                    media_encoded = message["message"]
-                    filename = message.get("filename", "unknown")
+                if message["type"] == "PUBLIC_KEY":
+                    # Hand the key to the input thread waiting for it
+                    future = self.key_requests.pop(message["username"], None)
+                    if future:
+                        future.set_result(message["public_key"])
 
+                if message["type"] == "DIRECT_MESSAGE" and message["message"]:
+                    # Decrypt and display a message sent only to us
+                    toSend = bytes.fromhex(message["message"])
+                    toSend = decrypt(toSend, private_key)
+                    self.search_index.add(message["username"], toSend)
                     print(
-                        f"Receiving {filename} from {message['username']}..."
+                        f"{colors[message['color']]}[DM] {message['username']}: {toSend}{colors['reset']}"   # noqa
                     )
 
-                    if not os.path.exists("received_media"):
-                        os.makedirs("received_media")
-
-                    media_bytes = bytes.fromhex(media_encoded)
-                    media_path = os.path.join("received_media", filename)
-                    with open(media_path, "wb") as f:
-                        f.write(media_bytes)
-
-                    print(f"{colors['green']}Media saved to {media_path}{colors['reset']}")     # noqa
-
-            except websockets.exceptions.ConnectionClosedError:
+                if message["type"] == "MEDIA_MESSAGE":
+                    # Older servers send the whole file in a single frame
+                    message.update({
+                        "type": "MEDIA_CHUNK",
+                        "transfer_id": uuid.uuid4().hex,
+                        "seq": 0,
+                        "total": 1,
+                        "size": len(message["message"]),
+                    })
+
+                if message["type"] == "MEDIA_CHUNK":
+                    self.receive_media_chunk(message)
+
+            except websockets.exceptions.ConnectionClosed:
                 print("Connection closed by the server.")
-                break
+                self.discard_media_transfers()
+                return True
 
             except Exception as e:
                 print(f"Error receiving message: {e}")
-                break
+                self.discard_media_transfers()
+                return False
+
+    def receive_media_chunk(self, message):
+        """
+        Hands a received media chunk to its writer's executor without waiting
+        for it to be written, so chat delivery continues during large
+        transfers.
+
+        Args:
+            message (dict): The MEDIA_CHUNK message.
+        """
+        loop = asyncio.get_running_loop()
+        transfer_id = message["transfer_id"]
+
+        if message["seq"] == 0:
+            if message.get("recipient"):
+                # Direct transfers are encrypted for our public key
+                writer = MediaWriter(
+                    message.get("filename"),
+                    direct_media_size(
+                        message["size"], rsa.common.byte_size(private_key.n)
+                    ),
+                    partial(decrypt, private_key=private_key)
+                )
+            else:
+                writer = MediaWriter(
+                    message.get("filename"), message["size"] // 2
+                )
+            self.media_transfers[transfer_id] = writer
+            print(
+                f"Receiving {writer.filename} from {message['username']}..."
+            )
+            loop.run_in_executor(writer.executor, writer.open)
+
+        writer = self.media_transfers.get(transfer_id)
+        if writer is None:
+            # The transfer started before we joined the room
+            return
+
+        written = loop.run_in_executor(
+            writer.executor, writer.write, message["message"]
+        )
+        if writer.size >= PROGRESS_MIN_SIZE:
+            written.add_done_callback(
+                lambda _: self.media_progress(writer, message)
+            )
+
+        if message["seq"] + 1 == message["total"]:
+            del self.media_transfers[transfer_id]
+            saved = loop.run_in_executor(writer.executor, writer.finish)
+            saved.add_done_callback(
+                lambda future: self.media_saved(writer, message, future)
+            )
+
+    def discard_media_transfers(self):
+        """
+        Removes the temporary files of transfers cut off by a lost connection,
+        their remaining chunks will not arrive on the next one.
+        """
+        loop = asyncio.get_running_loop()
+        for writer in self.media_transfers.values():
+            print(f"{colors['red']}Transfer of {writer.filename} was interrupted{colors['reset']}")  # noqa
+            loop.run_in_executor(writer.executor, writer.discard)
+        self.media_transfers.clear()
+
+    def media_progress(self, writer, message):
+        """
+        Reports the progress of a large media transfer.
+
+        Args:
+            writer (MediaWriter): The writer of the transfer.
+            message (dict): The latest MEDIA_CHUNK message of the transfer.
+        """
+        percent = writer.report_progress()
+        if percent is None:
+            return
+
+        print(f"Receiving {writer.filename}: {percent}%")
+
+    def media_saved(self, writer, message, future):
+        """
+        Reports the outcome of a media transfer once it has been written.
+
+        Args:
+            writer (MediaWriter): The writer of the transfer.
+            message (dict): The last MEDIA_CHUNK message of the transfer.
+            future (asyncio.Future): The future of MediaWriter.finish.
+        """
+        error = future.exception()
+        if error:
+            print(f"{colors['red']}Error saving {writer.filename}: {error}{colors['reset']}")  # noqa
+            return
+
+        print(f"{colors['green']}Media saved to {writer.path}{colors['reset']}")  # noqa
+
+
+def send_direct_message(client, command):
+    """
+    Sends a message or file to a single member of the room, encrypted with
+    that member's public key.
+
+    Args:
+        client (ChatClient): The chat client instance.
+        command (str): The command, '/dm <username> <message>' or '/dm <username> /media <path>'.
+    """
+    parts = command.split(maxsplit=2)
+    if len(parts) < 3:
+        print("Usage: /dm <username> <message> or /dm <username> /media <path>")
+        return
+
+    recipient, message = parts[1], parts[2]
+    recipient_key = client.get_peer_key(recipient)
+    if recipient_key is None:
+        print(f"{colors['red']}[ERROR] {recipient} is not in the chat room.{colors['reset']}")  # noqa
+        return
+
+    filename = None
+    if message.startswith("/media"):
+        try:
+            with open(message.split(maxsplit=1)[1], "rb") as file:
+                file_content = file.read()
+            filename = os.path.basename(message.split(maxsplit=1)[1])
+            print(f"Sending {filename} to {recipient}...")
+        except Exception as e:
+            print(f"Error reading file: {e}")
+            return
+        # Files are hex encoded so they can go through the text encryption
+        message = file_content.hex()
+
+    msg = {
+        "type": "DIRECT_MESSAGE",
+        "username": client.username,
+        "room": client.room,
+        "recipient": recipient,
+        "message": encrypt(message, recipient_key).hex(),
+        "code": 200,
+        "filename": filename
+    }
+    if not fits_in_frame(msg):
+        print(f"{colors['red']}[ERROR] {filename or 'The message'} is too large, direct files must be under about 240 KB.{colors['reset']}")  # noqa
+        return
+    asyncio.run(
+        client.send_message(msg)
+    )
+
+    if not filename:
+        client.search_index.add(client.username, message)
 
 
 def user_input_loop(client):
@@ -206,6 +469,22 @@ def user_input_loop(client):
         type = "CHAT_MESSAGE"
         filename = None
 
+        if message.startswith("/search"):
+            # Search the local history of the room
+            query = message[len("/search"):].strip()
+            started = time.perf_counter()
+            hits = client.search_index.search(query)
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"{len(hits)} results for '{query}' in {elapsed:.1f} ms")
+            for score, timestamp, user, text in hits:
+                sent = time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+                print(f"{colors['blue']}[{sent}] {user}: {text}{colors['reset']}")  # noqa
+            continue
+
+        if message.startswith("/dm"):
+            send_direct_message(client, message)
+            continue
+
         if message.startswith("/media"):
             # Handle media message
             try:
@@ -230,11 +509,17 @@ def user_input_loop(client):
             "code": 200,
             "filename": filename
         }
+        if not fits_in_frame(msg):
+            print(f"{colors['red']}[ERROR] {filename or 'The message'} is too large, files must be under 512 KB.{colors['reset']}")  # noqa
+            continue
 
         asyncio.run(
             client.send_message(msg)
         )
 
+        if type == "CHAT_MESSAGE":
+            client.search_index.add(client.username, message)
+
 
 if __name__ == "__main__":
     HOST = '45.90.12.30'  # Server IP address
@@ -244,6 +529,7 @@ if __name__ == "__main__":
     room = input("Enter the chat room you want to join: ")
 
     client = ChatClient(HOST, PORT, username, room)
+    atexit.register(client.search_index.save)
 
     # Start the user input loop in a separate thread
     input_thread = threading.Thread(target=user_input_loop, args=(client,))
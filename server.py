@@ -2,6 +2,39 @@ import asyncio
 import websockets
 import json
 import rsa
+import secrets
+import time
+import uuid
+from collections import deque
+from traffic import TrafficRecorder
+
+# Outbound priority classes, lowest value is sent first
+PRIORITY_SYSTEM = 0
+PRIORITY_CHAT = 1
+PRIORITY_MEDIA = 2
+PRIORITY_NAMES = {
+    PRIORITY_SYSTEM: "system",
+    PRIORITY_CHAT: "chat",
+    PRIORITY_MEDIA: "media",
+}
+
+# Number of hex characters carried by a single MEDIA_CHUNK frame, a multiple
+# of the 256 hex characters of an RSA block so encrypted chunks decrypt alone
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Largest frame accepted from a client. Files are uploaded in one frame, so
+# this also limits their size (MAX_FRAME_SIZE in storage.py)
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Bytes of media a connection may have queued before senders to it are
+# paused, and seconds it may stay over that limit before it is closed as a
+# slow consumer, so one stalled client cannot exhaust server memory
+MAX_QUEUED_MEDIA_BYTES = 16 * 1024 * 1024
+SLOW_CONSUMER_TIMEOUT = 10
+
+# Session resumption settings
+TICKET_LIFETIME = 300  # Seconds a ticket stays valid after a disconnect
+RESERVATION_GRACE = 30  # Seconds a dropped user's name stays reserved
 
 
 def encrypt(message, public_key):
@@ -28,6 +61,200 @@ def encrypt(message, public_key):
     return encrypted_message
 
 
+def split_media_message(msg):
+    """
+    Splits a media message into MEDIA_CHUNK frames that can be interleaved
+    with higher priority traffic.
+
+    Args:
+        msg (dict): The MEDIA_MESSAGE to be split.
+
+    Returns:
+        list: The JSON encoded MEDIA_CHUNK frames, in order.
+    """
+    payload = msg["message"]
+    transfer_id = uuid.uuid4().hex
+    total = max(1, -(-len(payload) // MEDIA_CHUNK_SIZE))
+
+    frames = []
+    for seq in range(total):
+        chunk = dict(msg)
+        chunk.update({
+            "type": "MEDIA_CHUNK",
+            "transfer_id": transfer_id,
+            "seq": seq,
+            "total": total,
+            "size": len(payload),
+            "message": payload[
+                seq * MEDIA_CHUNK_SIZE:(seq + 1) * MEDIA_CHUNK_SIZE
+            ],
+        })
+        frames.append(json.dumps(chunk))
+
+    return frames
+
+
+class ClientConnection:
+    """
+    Wraps a client's websocket with one outbound queue per priority class.
+
+    A single sender task drains the queues, always taking the next frame
+    from the highest priority class that has one, so a media transfer in
+    progress never delays chat or system messages by more than one chunk.
+
+    Media senders wait while more than MAX_QUEUED_MEDIA_BYTES are queued for
+    the client. A client that does not catch up within SLOW_CONSUMER_TIMEOUT
+    seconds is closed, and can resume its session with its ticket.
+    """
+
+    def __init__(self, websocket):
+        """
+        Initializes the outbound queues and starts the sender task.
+
+        Args:
+            websocket (websockets.WebSocketServerProtocol): The client's websocket connection.
+        """
+        self.websocket = websocket
+        self.remote_address = websocket.remote_address
+        self.queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self.wait_stats = {
+            priority: {"sent": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for priority in PRIORITY_NAMES
+        }
+        self.queued_media_bytes = 0
+        self.media_room = asyncio.Event()
+        self.media_room.set()
+        self.overflowed = False
+        self.pending = asyncio.Event()
+        self.sender_task = asyncio.create_task(self.send_loop())
+
+    def enqueue(self, message, priority=PRIORITY_CHAT):
+        """
+        Queues a message to be sent to the client.
+
+        Args:
+            message (str): The message to be sent.
+            priority (int, optional): The priority class of the message. Defaults to PRIORITY_CHAT.
+        """
+        if self.overflowed:
+            return
+
+        if priority == PRIORITY_MEDIA:
+            self.queued_media_bytes += len(message)
+            if self.queued_media_bytes > MAX_QUEUED_MEDIA_BYTES:
+                self.media_room.clear()
+
+        self.queues[priority].append((time.monotonic(), message))
+        self.pending.set()
+
+    async def wait_for_media_room(self):
+        """
+        Waits until the queued media is back under MAX_QUEUED_MEDIA_BYTES, and
+        closes the client if it does not catch up within SLOW_CONSUMER_TIMEOUT
+        seconds.
+        """
+        try:
+            await asyncio.wait_for(
+                self.media_room.wait(), SLOW_CONSUMER_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            self.drop_slow_consumer()
+
+    def drop_slow_consumer(self):
+        """
+        Closes the client and drops everything queued for it.
+        """
+        print(
+            f"Closing slow client {self.remote_address}: "
+            f"{self.queued_media_bytes} bytes of media queued"
+        )
+        self.overflowed = True
+        for queue in self.queues.values():
+            queue.clear()
+        self.queued_media_bytes = 0
+        self.media_room.set()
+        # 1013: try again later, the client reconnects and resumes
+        asyncio.ensure_future(
+            self.websocket.close(code=1013, reason="Too much media queued")
+        )
+
+    def next_message(self):
+        """
+        Pops the next message to be sent, honouring priority order.
+
+        Returns:
+            tuple: The priority class, enqueue time and message, or None if all queues are empty.
+        """
+        for priority, queue in self.queues.items():
+            if queue:
+                queued_at, message = queue.popleft()
+                if priority == PRIORITY_MEDIA:
+                    self.queued_media_bytes -= len(message)
+                    if self.queued_media_bytes <= MAX_QUEUED_MEDIA_BYTES:
+                        self.media_room.set()
+                return priority, queued_at, message
+        return None
+
+    async def send_loop(self):
+        """
+        Sends queued messages to the client until the connection closes.
+        """
+        while True:
+            await self.pending.wait()
+            item = self.next_message()
+            if item is None:
+                self.pending.clear()
+                continue
+
+            priority, queued_at, message = item
+            wait = time.monotonic() - queued_at
+            stats = self.wait_stats[priority]
+            stats["sent"] += 1
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+
+            try:
+                await self.websocket.send(message)
+            except websockets.exceptions.ConnectionClosed:
+                break
+            except Exception as e:
+                print(f"Error sending message to client: {e}")
+
+            # send() does not yield while the transport has buffer room,
+            # give other tasks a chance to queue higher priority messages
+            await asyncio.sleep(0)
+
+    def get_metrics(self):
+        """
+        Returns the queue depth and wait time statistics of each priority class.
+
+        The media class also reports the queued bytes and their limit.
+
+        Returns:
+            dict: The metrics keyed by priority class name.
+        """
+        metrics = {}
+        for priority, name in PRIORITY_NAMES.items():
+            stats = self.wait_stats[priority]
+            metrics[name] = {
+                "depth": len(self.queues[priority]),
+                "sent": stats["sent"],
+                "total_wait": stats["total_wait"],
+                "max_wait": stats["max_wait"],
+            }
+        metrics["media"]["bytes"] = self.queued_media_bytes
+        metrics["media"]["max_bytes"] = MAX_QUEUED_MEDIA_BYTES
+        return metrics
+
+    def close(self):
+        """
+        Stops the sender task and drops any queued messages.
+        """
+        self.sender_task.cancel()
+        for queue in self.queues.values():
+            queue.clear()
+
+
 class ChatRoom:
     """
     Represents a chat room where multiple clients can join and communicate.
@@ -42,20 +269,29 @@ class ChatRoom:
         """
         self.room_name = room_name
         self.clients = []
-        self.users = []
+        self.users = {}
+        self.public_keys = {}
         (self.public_key, self.private_key) = rsa.newkeys(1024)
 
-    async def add_client(self, client_socket, username):
+    async def add_client(self, client_socket, username, public_key=None):
         """
         Adds a new client to the chat room.
 
+        A connection may join several usernames, e.g. a web bridge sharing
+        one upstream connection between its users. It receives each room
+        message once.
+
         Args:
-            client_socket (websockets.WebSocketServerProtocol): The client's websocket connection.
+            client_socket (ClientConnection): The client's connection.
             username (str): The username of the client.
+            public_key (str, optional): The client's PEM public key, handed out for direct messages. Defaults to None.
         """
         # Add the client to the room
-        self.clients.append(client_socket)
-        self.users.append(username)
+        if client_socket not in self.clients:
+            self.clients.append(client_socket)
+        self.users[username] = client_socket
+        if public_key:
+            self.public_keys[username] = public_key
 
         welcome_message = {
             "type": "SYSTEM_MESSAGE",
@@ -64,22 +300,31 @@ class ChatRoom:
             "code": 200
         }
         await self.broadcast_message(
-            json.dumps(welcome_message), client_socket
+            json.dumps(welcome_message), client_socket, PRIORITY_SYSTEM
         )
 
-    async def remove_client(self, client_socket):
+    async def remove_client(self, client_socket, username=None):
         """
         Removes a client from the chat room.
 
         Args:
-            client_socket (websockets.WebSocketServerProtocol): The client's websocket connection.
+            client_socket (ClientConnection): The client's connection.
+            username (str, optional): The username to remove. Defaults to all usernames joined through the connection.
         """
-        if client_socket in self.clients:
-            for user, socket in zip(self.users, self.clients):
-                if socket == client_socket:
-                    username = user
-                    break
-
+        if client_socket not in self.clients:
+            return
+
+        if username is None:
+            usernames = [
+                user for user, socket in self.users.items()
+                if socket == client_socket
+            ]
+        elif self.users.get(username) == client_socket:
+            usernames = [username]
+        else:
+            usernames = []
+
+        for username in usernames:
             goodbye_message = {
                 "type": "SYSTEM_MESSAGE",
                 "color": "red",
@@ -89,28 +334,29 @@ class ChatRoom:
                 "room": self.room_name
             }
             await self.broadcast_message(
-                json.dumps(goodbye_message), client_socket
+                json.dumps(goodbye_message), client_socket, PRIORITY_SYSTEM
             )
+            del self.users[username]
+            self.public_keys.pop(username, None)
 
-            # Remove the client from the room
+        # Remove the client from the room once none of its users are left
+        if client_socket not in self.users.values():
             self.clients.remove(client_socket)
-            if username:
-                self.users.remove(username)
 
-    async def broadcast_message(self, message, sender_socket=None):
+    async def broadcast_message(
+        self, message, sender_socket=None, priority=PRIORITY_CHAT
+    ):
         """
-        Broadcasts a message to all clients in the chat room except the sender.
+        Queues a message for all clients in the chat room except the sender.
 
         Args:
             message (str): The message to be broadcasted.
-            sender_socket (websockets.WebSocketServerProtocol, optional): The sender's websocket connection. Defaults to None.
+            sender_socket (ClientConnection, optional): The sender's connection. Defaults to None.
+            priority (int, optional): The priority class of the message. Defaults to PRIORITY_CHAT.
         """
         for client in self.clients:
             if client != sender_socket:
-                try:
-                    await client.send(message)
-                except Exception as e:
-                    print(f"Error sending message to client: {e}")
+                client.enqueue(message, priority)
 
     def is_empty(self):
         """
@@ -127,17 +373,26 @@ class ChatServer:
     Represents a chat server that manages multiple chat rooms.
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, recorder=None):
         """
         Initializes a new chat server.
 
         Args:
             host (str): The host address of the server.
             port (int): The port number of the server.
+            recorder (traffic.TrafficRecorder, optional): Records inbound frames for replay. Defaults to None.
         """
         self.host = host
         self.port = port
         self.chat_rooms = {}
+        self.connections = {}
+        self.recorder = recorder
+        self.tickets = {}
+        self.user_tickets = {}
+        self.reservations = {}
+        # (expires, ticket) of dropped sessions, oldest first since every
+        # ticket gets the same lifetime
+        self.expiring_tickets = deque()
         print(f"Server listening on {self.host}:{self.port}")
 
     async def handle_client(self, websocket, path):
@@ -148,14 +403,37 @@ class ChatServer:
             websocket (websockets.WebSocketServerProtocol): The client's websocket connection.
             path (str): The URL path of the websocket connection.
         """
+        connection = ClientConnection(websocket)
+        self.connections[websocket] = connection
+
+        try:
+            await self.receive_from_client(connection)
+        finally:
+            connection.close()
+            del self.connections[websocket]
+            if self.recorder:
+                self.recorder.record_disconnect(connection)
+
+    async def receive_from_client(self, connection):
+        """
+        Receives and routes messages from a single client until it disconnects.
+
+        Args:
+            connection (ClientConnection): The client's connection.
+        """
+        websocket = connection.websocket
+
         while True:
             try:
                 message_raw = await websocket.recv()
                 message = json.loads(message_raw)
 
+                if self.recorder and message:
+                    self.recorder.record(connection, message_raw, message)
+
                 if not message:
                     print(f"Connection closed with {websocket.remote_address}")
-                    await self.remove_client_from_rooms(websocket)
+                    await self.remove_client_from_rooms(connection, True)
                     break
 
                 if message["type"] == "JOIN_ROOM":
@@ -167,7 +445,7 @@ class ChatServer:
 
                     if self.is_username_unique(room_name, username):
                         await self.chat_rooms[room_name].add_client(
-                            websocket, username
+                            connection, username, message["public_key"]
                         )
                         print(f"Added {username} to chat room {room_name}")
 
@@ -188,18 +466,66 @@ class ChatServer:
                             "color": "green",
                             "message": "[INFO] Connected to the chat room.",
                             "code": 200,
+                            "username": username,
+                            "room": room_name,
                             "public_key": encrypted_public_key.hex(),
                             "private_key": encrypted_private_key.hex(),
+                            "ticket": self.issue_ticket(room_name, username),
                         }
                     else:
                         msg = {
                             "type": "SYSTEM_MESSAGE",
                             "color": "red",
                             "message": "[ERROR] Username already exists in the room. Please choose a different username.",
-                            "code": 409
+                            "code": 409,
+                            "username": username,
+                            "room": room_name
                         }
 
-                    await websocket.send(json.dumps(msg))
+                    connection.enqueue(json.dumps(msg), PRIORITY_SYSTEM)
+                    continue
+
+                elif message["type"] == "RESUME_ROOM":
+                    room_name = message["room"]
+                    username = message["username"]
+                    session = self.redeem_ticket(
+                        message.get("ticket"), room_name, username
+                    )
+
+                    if session:
+                        # The dropped connection may not be detected yet,
+                        # in which case the ticket still belongs to it
+                        room = session["room"]
+                        old_connection = room.users.get(username)
+                        if old_connection:
+                            await room.remove_client(old_connection, username)
+
+                        await room.add_client(
+                            connection, username, session["public_key"]
+                        )
+                        print(f"Resumed {username} in chat room {room_name}")
+
+                        msg = {
+                            "type": "SYSTEM_MESSAGE",
+                            "color": "green",
+                            "message": "[INFO] Reconnected to the chat room.",
+                            "code": 200,
+                            "username": username,
+                            "room": room_name,
+                            "resumed": True,
+                            "ticket": self.issue_ticket(room_name, username),
+                        }
+                    else:
+                        msg = {
+                            "type": "SYSTEM_MESSAGE",
+                            "color": "red",
+                            "message": "[ERROR] Session expired, joining the chat room again.",
+                            "code": 401,
+                            "username": username,
+                            "room": room_name
+                        }
+
+                    connection.enqueue(json.dumps(msg), PRIORITY_SYSTEM)
                     continue
 
                 elif message["type"] == "CHAT_MESSAGE":
@@ -212,7 +538,7 @@ class ChatServer:
                         "code": 200,
                     }
                     await self.chat_rooms[room_name].broadcast_message(
-                        json.dumps(msg), websocket
+                        json.dumps(msg), connection, PRIORITY_CHAT
                     )
 
                 elif message["type"] == "MEDIA_MESSAGE":
@@ -225,27 +551,128 @@ class ChatServer:
                         "code": 200,
                         "filename": message["filename"],
                     }
-                    await self.chat_rooms[room_name].broadcast_message(
-                        json.dumps(msg), websocket
-                    )
+                    # Send large files as chunks so chat can overtake them
+                    room = self.chat_rooms[room_name]
+                    for chunk in split_media_message(msg):
+                        await room.broadcast_message(
+                            chunk, connection, PRIORITY_MEDIA
+                        )
+                    # Stop reading from the sender while a receiver is behind
+                    await asyncio.gather(*(
+                        client.wait_for_media_room()
+                        for client in room.clients if client != connection
+                    ))
+
+                elif message["type"] == "PUBLIC_KEY_REQUEST":
+                    room = self.chat_rooms.get(message["room"])
+                    recipient = message["recipient"]
+                    if self.is_member(room, message.get("username"), connection):
+                        key = room.public_keys.get(recipient)
+                        code = 200 if key else 404
+                    else:
+                        key = None
+                        code = 403
+                    msg = {
+                        "type": "PUBLIC_KEY",
+                        "username": recipient,
+                        "room": message["room"],
+                        "public_key": key,
+                        "code": code,
+                    }
+                    connection.enqueue(json.dumps(msg), PRIORITY_SYSTEM)
+
+                elif message["type"] == "DIRECT_MESSAGE":
+                    room = self.chat_rooms.get(message["room"])
+                    recipient = message["recipient"]
+
+                    if not self.is_member(room, message.get("username"), connection):
+                        msg = {
+                            "type": "SYSTEM_MESSAGE",
+                            "color": "red",
+                            "message": "[ERROR] You are not in the chat room.",
+                            "code": 403,
+                            "username": message.get("username"),
+                            "room": message["room"]
+                        }
+                        connection.enqueue(json.dumps(msg), PRIORITY_SYSTEM)
+                        continue
+
+                    recipient_socket = room.users.get(recipient)
+                    if recipient_socket is None:
+                        msg = {
+                            "type": "SYSTEM_MESSAGE",
+                            "color": "red",
+                            "message": f"[ERROR] {recipient} is not in the chat room.",
+                            "code": 404,
+                            "username": message["username"],
+                            "room": message["room"]
+                        }
+                        connection.enqueue(json.dumps(msg), PRIORITY_SYSTEM)
+                        continue
+
+                    msg = {
+                        "type": "DIRECT_MESSAGE",
+                        "color": "blue",
+                        "username": message["username"],
+                        "recipient": recipient,
+                        "message": message["message"],
+                        "code": 200,
+                        "filename": message.get("filename"),
+                    }
+                    # Only the recipient's connection is involved
+                    if msg["filename"]:
+                        for chunk in split_media_message(msg):
+                            recipient_socket.enqueue(chunk, PRIORITY_MEDIA)
+                        await recipient_socket.wait_for_media_room()
+                    else:
+                        recipient_socket.enqueue(json.dumps(msg), PRIORITY_CHAT)
+
+                elif message["type"] == "QUEUE_STATS":
+                    msg = {
+                        "type": "QUEUE_STATS",
+                        "code": 200,
+                        "queues": self.get_queue_metrics(),
+                    }
+                    connection.enqueue(json.dumps(msg), PRIORITY_SYSTEM)
 
                 elif message["type"] == "LEAVE_ROOM":
                     print("Disconnecting...")
-                    self.remove_client_from_rooms(websocket)
+                    room = self.chat_rooms.get(message.get("room"))
+                    if room and message.get("username"):
+                        await room.remove_client(
+                            connection, message["username"]
+                        )
+                        self.revoke_ticket(room.room_name, message["username"])
+                    else:
+                        await self.remove_client_from_rooms(connection)
                     print(f"Connection closed with {websocket.remote_address}")
                     continue
 
             except websockets.exceptions.ConnectionClosedError:
                 print(f"Connection closed by peer: {websocket.remote_address}")
-                await self.remove_client_from_rooms(websocket)
+                await self.remove_client_from_rooms(connection, True)
                 break
 
             except Exception as e:
                 print(f"Connection closed by peer: {websocket.remote_address}")
-                await self.remove_client_from_rooms(websocket)
+                await self.remove_client_from_rooms(connection, True)
                 print(f"Error handling client: {e}")
                 break
 
+    def is_member(self, room, username, connection):
+        """
+        Checks if a connection joined a chat room under a username.
+
+        Args:
+            room (ChatRoom): The chat room, or None if it does not exist.
+            username (str): The username the connection claims.
+            connection (ClientConnection): The client's connection.
+
+        Returns:
+            bool: True if the username in the room belongs to the connection, False otherwise.
+        """
+        return room is not None and room.users.get(username) is connection
+
     def is_username_unique(self, room_name, username):
         """
         Checks if a username is unique in a chat room.
@@ -261,17 +688,161 @@ class ChatServer:
         if room:
             if username in room.users:
                 return False
+
+        # Names of recently dropped users are held for their reconnect
+        expires = self.reservations.get((room_name, username))
+        if expires and expires > time.monotonic():
+            return False
         return True
 
-    async def remove_client_from_rooms(self, websocket):
+    def issue_ticket(self, room_name, username):
+        """
+        Issues a resumption ticket that lets a user rejoin a chat room
+        without a new key exchange, replacing any previous ticket.
+
+        Args:
+            room_name (str): The name of the chat room.
+            username (str): The username of the client.
+
+        Returns:
+            str: The ticket.
+        """
+        self.revoke_ticket(room_name, username)
+        self.expire_tickets()
+
+        # The ticket starts expiring once its user disconnects
+        ticket = secrets.token_urlsafe(24)
+        room = self.chat_rooms[room_name]
+        self.tickets[ticket] = {
+            "room": room,
+            "room_name": room_name,
+            "username": username,
+            "public_key": room.public_keys.get(username),
+            "expires": None,
+        }
+        self.user_tickets[(room_name, username)] = ticket
+        return ticket
+
+    def expire_tickets(self):
+        """
+        Forgets the tickets and reservations that expired, taking only the
+        expired ones off the front of the expiry queue.
+        """
+        now = time.monotonic()
+        while self.expiring_tickets and self.expiring_tickets[0][0] <= now:
+            expires, ticket = self.expiring_tickets.popleft()
+            session = self.tickets.get(ticket)
+            # Redeemed and revoked tickets are already gone
+            if session and session["expires"] == expires:
+                self.revoke_ticket(session["room_name"], session["username"])
+
+    def revoke_ticket(self, room_name, username):
+        """
+        Revokes a user's resumption ticket and name reservation.
+
+        Args:
+            room_name (str): The name of the chat room.
+            username (str): The username of the client.
+        """
+        ticket = self.user_tickets.pop((room_name, username), None)
+        self.tickets.pop(ticket, None)
+        self.reservations.pop((room_name, username), None)
+
+    def redeem_ticket(self, ticket, room_name, username):
+        """
+        Redeems a resumption ticket. A ticket can only be used once.
+
+        Args:
+            ticket (str): The ticket presented by the client.
+            room_name (str): The name of the chat room to resume.
+            username (str): The username to resume.
+
+        Returns:
+            dict: The session with the chat room to rejoin, or None if the ticket is invalid, expired, or the room was recreated with new keys.
+        """
+        session = self.tickets.get(ticket) if ticket else None
+        if session is None:
+            return None
+
+        self.revoke_ticket(session["room_name"], session["username"])
+        if session["expires"] and session["expires"] <= time.monotonic():
+            return None
+        if (session["room_name"], session["username"]) != (room_name, username):
+            return None
+
+        room = self.chat_rooms.get(room_name)
+        if room is not session["room"]:
+            return None
+
+        # After the reservation lapsed someone else may have taken the name
+        if session["expires"] and username in room.users:
+            return None
+        return session
+
+    async def remove_client_from_rooms(self, connection, reserve=False):
         """
         Removes a client from all chat rooms.
 
         Args:
-            websocket (websockets.WebSocketServerProtocol): The client's websocket connection.
+            connection (ClientConnection): The client's connection.
+            reserve (bool, optional): Keep the client's tickets valid and hold its usernames so it can resume. Defaults to False.
         """
+        now = time.monotonic()
         for room in self.chat_rooms.values():
-            await room.remove_client(websocket)
+            for username, socket in room.users.items():
+                if socket != connection:
+                    continue
+
+                key = (room.room_name, username)
+                if reserve and key in self.user_tickets:
+                    ticket = self.user_tickets[key]
+                    self.tickets[ticket]["expires"] = now + TICKET_LIFETIME
+                    self.expiring_tickets.append((now + TICKET_LIFETIME, ticket))
+                    self.reservations[key] = now + RESERVATION_GRACE
+                else:
+                    self.revoke_ticket(*key)
+
+        for room in self.chat_rooms.values():
+            await room.remove_client(connection)
+
+    def get_queue_metrics(self):
+        """
+        Aggregates outbound queue metrics over all connected clients.
+
+        Returns:
+            dict: The total queue depth, number of sent messages and average
+            and maximum wait time in seconds, keyed by priority class name.
+            The media class also has the total queued bytes, the largest
+            number of bytes queued for one client and the per-client limit.
+        """
+        totals = {
+            name: {"depth": 0, "sent": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+        totals["media"].update({
+            "bytes": 0,
+            "max_client_bytes": 0,
+            "max_bytes": MAX_QUEUED_MEDIA_BYTES,
+        })
+        for connection in self.connections.values():
+            for name, metrics in connection.get_metrics().items():
+                total = totals[name]
+                total["depth"] += metrics["depth"]
+                total["sent"] += metrics["sent"]
+                total["total_wait"] += metrics["total_wait"]
+                total["max_wait"] = max(total["max_wait"], metrics["max_wait"])
+
+            media = totals["media"]
+            media["bytes"] += connection.queued_media_bytes
+            media["max_client_bytes"] = max(
+                media["max_client_bytes"], connection.queued_media_bytes
+            )
+
+        for total in totals.values():
+            total_wait = total.pop("total_wait")
+            total["avg_wait"] = total_wait / total["sent"] if total["sent"] else 0.0
+
+        return totals
 
     async def remove_empty_rooms(self):
         """
@@ -289,7 +860,9 @@ class ChatServer:
         """
         Starts the chat server and listens for incoming connections.
         """
-        async with websockets.serve(self.handle_client, self.host, self.port):
+        async with websockets.serve(
+            self.handle_client, self.host, self.port, max_size=MAX_FRAME_SIZE
+        ):
             await self.remove_empty_rooms()
             await asyncio.Future()  # Run forever
 
@@ -297,5 +870,15 @@ class ChatServer:
 if __name__ == "__main__":
     HOST = '0.0.0.0'  # Use '0.0.0.0' to listen on all available interfaces
     PORT = 7081  # Choose any available port
-    server = ChatServer(HOST, PORT)
-    asyncio.run(server.start_server())
\ No newline at end of file
+    RECORD_FILE = None  # Set to e.g. 'traffic.jsonl.gz' to record inbound traffic
+    REDACT_RECORDING = True  # Leave payloads and usernames out of recordings
+
+    recorder = (
+        TrafficRecorder(RECORD_FILE, REDACT_RECORDING) if RECORD_FILE else None
+    )
+    server = ChatServer(HOST, PORT, recorder)
+    try:
+        asyncio.run(server.start_server())
+    finally:
+        if recorder:
+            recorder.close()
\ No newline at end of file
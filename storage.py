@@ -0,0 +1,400 @@
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Search index settings
+INDEX_DIR = "search_index"
+MAX_INDEXED_MESSAGES = 5000  # Messages indexed per room, oldest are dropped
+INDEX_SAVE_INTERVAL = 200  # Save the index after this many new messages
+SEARCH_RESULTS = 10  # Number of hits returned by /search
+
+# Largest frame the server accepts (MAX_FRAME_SIZE in server.py). Files are
+# sent in a single frame, hex encoded, so room files must stay under 512 KB
+# and direct files, hex encoded again after encryption, under about 240 KB
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Received media settings
+MEDIA_DIR = "received_media"
+MAX_MEDIA_SIZE = 512 * 1024  # Largest single file accepted, in bytes
+MEDIA_DISK_QUOTA = 1024 * 1024 * 1024  # Total size allowed in MEDIA_DIR
+PROGRESS_MIN_SIZE = 128 * 1024  # Report progress for files at least this big
+PROGRESS_STEP = 10  # Report progress every PROGRESS_STEP percent
+
+# Decoding and disk writes for received media run on this single worker
+media_executor = ThreadPoolExecutor(max_workers=1)
+
+# Direct transfers are decrypted with pure Python RSA, which takes seconds
+# per megabyte, so they get their own worker to not hold up room media
+direct_media_executor = ThreadPoolExecutor(max_workers=1)
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase search tokens.
+
+    Args:
+        text (str): The text to be tokenized.
+
+    Returns:
+        list: The tokens.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class SearchIndex:
+    """
+    An incrementally updated inverted index over the decrypted messages of a
+    chat room, ranked with BM25.
+
+    Only the messages are persisted, gzip compressed, and the postings are
+    rebuilt when the index is loaded. At most MAX_INDEXED_MESSAGES are kept.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, room):
+        """
+        Initializes the index of a chat room, loading it from disk if saved.
+
+        Args:
+            room (str): The name of the chat room.
+        """
+        room_hash = hashlib.sha256(room.encode()).hexdigest()[:16]
+        self.path = os.path.join(INDEX_DIR, f"{room_hash}.json.gz")
+        self.messages = {}
+        self.postings = {}
+        self.total_length = 0
+        self.next_id = 0
+        self.unsaved = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.load()
+
+    def add(self, username, text, timestamp=None):
+        """
+        Adds a message to the index.
+
+        Args:
+            username (str): The author of the message.
+            text (str): The decrypted message.
+            timestamp (float, optional): When the message was sent. Defaults to now.
+        """
+        with self.lock:
+            self.insert(self.next_id, timestamp or time.time(), username, text)
+            self.next_id += 1
+
+            while len(self.messages) > MAX_INDEXED_MESSAGES:
+                self.remove(next(iter(self.messages)))
+
+            self.unsaved += 1
+            if self.unsaved < INDEX_SAVE_INTERVAL:
+                return
+            self.unsaved = 0
+
+        # Compressing the index takes a while, keep it off the caller's thread
+        threading.Thread(target=self.save, daemon=True).start()
+
+    def insert(self, message_id, timestamp, username, text):
+        """
+        Adds a message and its postings, the caller must hold the lock.
+
+        Args:
+            message_id (int): The id of the message.
+            timestamp (float): When the message was sent.
+            username (str): The author of the message.
+            text (str): The decrypted message.
+        """
+        tokens = tokenize(text)
+        self.messages[message_id] = (timestamp, username, text, len(tokens))
+        self.total_length += len(tokens)
+        for token, count in Counter(tokens).items():
+            self.postings.setdefault(token, {})[message_id] = count
+
+    def remove(self, message_id):
+        """
+        Removes a message and its postings, the caller must hold the lock.
+
+        Args:
+            message_id (int): The id of the message.
+        """
+        _, _, text, length = self.messages.pop(message_id)
+        self.total_length -= length
+        for token in set(tokenize(text)):
+            postings = self.postings[token]
+            del postings[message_id]
+            if not postings:
+                del self.postings[token]
+
+    def search(self, query, limit=SEARCH_RESULTS, since=None):
+        """
+        Returns the messages that best match a query.
+
+        Args:
+            query (str): The search terms.
+            limit (int, optional): The maximum number of hits. Defaults to SEARCH_RESULTS.
+            since (float, optional): Only match messages sent at or after this time. Defaults to all messages.
+
+        Returns:
+            list: The hits as (score, timestamp, username, text) tuples, best first.
+        """
+        with self.lock:
+            if not self.messages:
+                return []
+
+            count = len(self.messages)
+            average_length = self.total_length / count or 1
+            scores = defaultdict(float)
+
+            for token in set(tokenize(query)):
+                postings = self.postings.get(token)
+                if not postings:
+                    continue
+
+                matches = len(postings)
+                idf = math.log(1 + (count - matches + 0.5) / (matches + 0.5))
+                for message_id, frequency in postings.items():
+                    timestamp, _, _, length = self.messages[message_id]
+                    if since is not None and timestamp < since:
+                        continue
+                    length /= average_length
+                    norm = self.K1 * (1 - self.B + self.B * length)
+                    scores[message_id] += (
+                        idf * frequency * (self.K1 + 1) / (frequency + norm)
+                    )
+
+            best = heapq.nlargest(
+                limit, scores.items(), key=lambda item: (item[1], item[0])
+            )
+            return [
+                (score, *self.messages[message_id][:3])
+                for message_id, score in best
+            ]
+
+    def load(self):
+        """
+        Loads the saved messages of the room and rebuilds the postings.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as file:
+                saved = json.load(file)
+        except Exception as e:
+            print(f"Error loading search index: {e}")
+            return
+
+        with self.lock:
+            for message_id, timestamp, username, text in saved["messages"]:
+                self.insert(message_id, timestamp, username, text)
+            self.next_id = saved["next_id"]
+
+    def save(self):
+        """
+        Writes the indexed messages to disk, replacing the previous save.
+        """
+        with self.lock:
+            saved = {
+                "next_id": self.next_id,
+                "messages": [
+                    [message_id, timestamp, username, text]
+                    for message_id, (timestamp, username, text, _)
+                    in self.messages.items()
+                ],
+            }
+            self.unsaved = 0
+
+        with self.save_lock:
+            os.makedirs(INDEX_DIR, exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with gzip.open(temp_path, "wt", encoding="utf-8") as file:
+                json.dump(saved, file, separators=(",", ":"))
+            os.replace(temp_path, self.path)
+
+
+def fits_in_frame(message):
+    """
+    Checks whether a message is small enough for the server to accept it.
+    Larger frames make the server close the connection.
+
+    Args:
+        message (dict): The message to be sent.
+
+    Returns:
+        bool: True if the JSON encoded message is at most MAX_FRAME_SIZE bytes.
+    """
+    return len(json.dumps(message)) <= MAX_FRAME_SIZE
+
+
+def direct_media_size(size, key_size):
+    """
+    Returns the size of a direct file from the size of its transfer.
+
+    The file is hex encoded, encrypted in blocks that carry 11 bytes of
+    padding each and hex encoded again.
+
+    Args:
+        size (int): The size of the transfer in hex characters.
+        key_size (int): The size of the recipient's key in bytes.
+
+    Returns:
+        int: The size of the file in bytes, rounded up to a whole block.
+    """
+    return -(-size // 2 // key_size) * (key_size - 11) // 2
+
+
+class MediaWriter:
+    """
+    Streams a received media file into a temporary file in MEDIA_DIR and
+    atomically moves it into place once the transfer is complete.
+
+    All methods except report_progress block on disk I/O and are meant to be
+    run on the writer's executor, whose single worker keeps the writes in
+    order.
+    """
+
+    # Bytes in MEDIA_DIR, shared by all transfers. Rescanned whenever a
+    # transfer starts and updated as chunks are written and files removed.
+    disk_usage = 0
+    usage_lock = threading.Lock()
+
+    def __init__(self, filename, size, decrypt=None):
+        """
+        Initializes a new media writer.
+
+        Args:
+            filename (str): The name of the file sent by the peer.
+            size (int): The expected size of the file in bytes.
+            decrypt (callable, optional): Decrypts the chunks of a direct transfer. Defaults to None.
+        """
+        self.filename = os.path.basename(filename or "") or "unknown"
+        self.path = os.path.join(MEDIA_DIR, self.filename)
+        self.size = size
+        self.decrypt = decrypt
+        self.executor = direct_media_executor if decrypt else media_executor
+        self.received = 0
+        self.written = 0
+        self.reported = 0
+        self.temp_path = None
+        self.file = None
+        self.error = None
+
+    def open(self):
+        """
+        Checks the size limits and opens the temporary file.
+        """
+        try:
+            if self.size > MAX_MEDIA_SIZE:
+                raise ValueError(
+                    f"{self.filename} exceeds the maximum media size"
+                )
+
+            os.makedirs(MEDIA_DIR, exist_ok=True)
+            with MediaWriter.usage_lock:
+                MediaWriter.disk_usage = sum(
+                    entry.stat().st_size
+                    for entry in os.scandir(MEDIA_DIR) if entry.is_file()
+                )
+                if MediaWriter.disk_usage + self.size > MEDIA_DISK_QUOTA:
+                    raise ValueError(
+                        f"Saving {self.filename} would exceed the media disk quota"
+                    )
+
+            fd, self.temp_path = tempfile.mkstemp(
+                prefix=f".{self.filename}.", suffix=".part", dir=MEDIA_DIR
+            )
+            self.file = os.fdopen(fd, "wb")
+        except Exception as e:
+            self.error = e
+
+    def write(self, chunk):
+        """
+        Decodes a hex encoded chunk and appends it to the temporary file.
+
+        Args:
+            chunk (str): The hex encoded chunk.
+        """
+        if self.error:
+            return
+
+        try:
+            data = bytes.fromhex(chunk)
+            if self.decrypt:
+                # Direct transfers carry the file hex encoded and encrypted
+                data = bytes.fromhex(self.decrypt(data))
+            self.received += len(data)
+
+            if self.written + len(data) > MAX_MEDIA_SIZE:
+                raise ValueError(
+                    f"{self.filename} exceeds the maximum media size"
+                )
+
+            # The declared size may be wrong, so the quota is also checked
+            # against what is actually written
+            with MediaWriter.usage_lock:
+                if MediaWriter.disk_usage + len(data) > MEDIA_DISK_QUOTA:
+                    raise ValueError(
+                        f"Saving {self.filename} would exceed the media disk quota"
+                    )
+                MediaWriter.disk_usage += len(data)
+            self.file.write(data)
+            self.written += len(data)
+        except Exception as e:
+            self.error = e
+
+    def finish(self):
+        """
+        Closes the temporary file and renames it to its final path.
+
+        Returns:
+            str: The path the media was saved to.
+        """
+        if self.error:
+            self.discard()
+            raise self.error
+
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        return self.path
+
+    def discard(self):
+        """
+        Closes and removes the temporary file of a failed or unfinished
+        transfer.
+        """
+        if self.file:
+            self.file.close()
+
+        if self.temp_path and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+            with MediaWriter.usage_lock:
+                MediaWriter.disk_usage -= self.written
+
+    def report_progress(self):
+        """
+        Returns the percentage received if it crossed the next reporting step.
+
+        Returns:
+            int: The percentage received, or None if nothing should be reported.
+        """
+        if self.error or not self.size:
+            return None
+
+        percent = min(100, self.received * 100 // self.size)
+        if percent < self.reported + PROGRESS_STEP or percent == 100:
+            return None
+
+        self.reported = percent - percent % PROGRESS_STEP
+        return self.reported
@@ -0,0 +1,488 @@
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import queue
+import statistics
+import threading
+import time
+import websockets
+import rsa
+
+
+class TrafficRecorder:
+    """
+    Records the inbound frames of a chat server as gzip compressed JSON lines.
+
+    Each record holds the time since recording started, a connection id, the
+    message type, room, username, recipient, frame size and size of the
+    message field. Unless payloads are redacted, the raw frame is stored as
+    well.
+
+    Compressing frames of up to megabytes of media takes a while, so records
+    are written by a background thread and never on the server's event loop.
+    """
+
+    def __init__(self, path, redact=False):
+        """
+        Initializes a new traffic recorder.
+
+        Args:
+            path (str): The file to write the recording to.
+            redact (bool, optional): Leave out payloads and replace usernames with aliases. Defaults to False.
+        """
+        self.path = path
+        self.redact = redact
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+        self.started = time.monotonic()
+        self.connection_ids = {}
+        self.next_connection_id = itertools.count()
+        self.aliases = {}
+
+    def connection_id(self, connection):
+        """
+        Returns the id of a connection, assigning one on first use.
+
+        Args:
+            connection (object): The connection the frame arrived on.
+
+        Returns:
+            int: The connection id.
+        """
+        if connection not in self.connection_ids:
+            self.connection_ids[connection] = next(self.next_connection_id)
+        return self.connection_ids[connection]
+
+    def alias(self, username):
+        """
+        Returns a stable alias for a username.
+
+        Args:
+            username (str): The username to be hidden.
+
+        Returns:
+            str: The alias.
+        """
+        if username not in self.aliases:
+            self.aliases[username] = f"user{len(self.aliases)}"
+        return self.aliases[username]
+
+    def write(self, record):
+        """
+        Timestamps a record and queues it to be written.
+
+        Args:
+            record (dict): The record to be written.
+        """
+        record["t"] = round(time.monotonic() - self.started, 6)
+        self.queue.put(record)
+
+    def write_records(self):
+        """
+        Appends queued records to the recording until None is queued.
+        """
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def record(self, connection, message_raw, message):
+        """
+        Records an inbound frame.
+
+        Args:
+            connection (object): The connection the frame arrived on.
+            message_raw (str): The frame as received.
+            message (dict): The decoded frame.
+        """
+        username = message.get("username")
+        recipient = message.get("recipient")
+        if self.redact:
+            if username is not None:
+                username = self.alias(username)
+            if recipient is not None:
+                recipient = self.alias(recipient)
+
+        record = {
+            "c": self.connection_id(connection),
+            "type": message.get("type"),
+            "room": message.get("room"),
+            "user": username,
+            "size": len(message_raw),
+            "msize": len(message.get("message") or ""),
+        }
+        if recipient is not None:
+            record["to"] = recipient
+        if message.get("filename"):
+            record["file"] = True
+        if not self.redact:
+            record["payload"] = message_raw
+        self.write(record)
+
+    def record_disconnect(self, connection):
+        """
+        Records that a connection was closed.
+
+        Args:
+            connection (object): The closed connection.
+        """
+        if connection in self.connection_ids:
+            self.write({
+                "c": self.connection_ids.pop(connection),
+                "type": "DISCONNECT",
+            })
+
+    def close(self):
+        """
+        Writes the queued records and closes the recording.
+        """
+        self.queue.put(None)
+        self.writer.join()
+        self.file.close()
+
+
+def load_recording(path):
+    """
+    Loads the records of a recording.
+
+    Args:
+        path (str): The recording written by TrafficRecorder.
+
+    Returns:
+        list: The records, ordered by time.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return sorted(records, key=lambda record: record["t"])
+
+
+class TrafficReplayer:
+    """
+    Replays a recording against a chat server with the recorded arrival
+    pattern and measures how long relayed messages take to be delivered.
+
+    Chat and media payloads are replaced by tagged hex strings of the
+    recorded length, so the server sees the same frame sizes and every
+    delivery can be matched to the frame that caused it. Recorded tickets
+    are not valid on the replay server, so resumes use the tickets it hands
+    out to the replayed joins. Every connection is opened before the replay
+    clock starts, so handshakes cannot reorder frames of different
+    connections.
+    """
+
+    TAG_LENGTH = 16
+
+    def __init__(self, host, port, records, speed=1.0, drain=2.0):
+        """
+        Initializes a new traffic replayer.
+
+        Args:
+            host (str): The host address of the server.
+            port (int): The port number of the server.
+            records (list): The records to be replayed.
+            speed (float, optional): The replay speed, 2.0 replays twice as fast. Defaults to 1.0.
+            drain (float, optional): Seconds to keep connections open after their last frame. Defaults to 2.0.
+        """
+        self.host = host
+        self.port = port
+        self.records = records
+        self.speed = speed
+        self.drain = drain
+        (self.public_key, _) = rsa.newkeys(512)
+        self.sent_at = {}
+        self.transfers = {}
+        self.tickets = {}
+        # frames_sent only grows after a send, which may yield to other
+        # connections, so tags are counted separately
+        self.tags = itertools.count()
+        self.latencies = []
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.last_sent = None
+
+    def build_frame(self, record, ticket=None):
+        """
+        Rebuilds the frame of a record.
+
+        Args:
+            record (dict): The record to be replayed.
+            ticket (str, optional): The ticket to resume with, a resume without one is replayed as a join. Defaults to None.
+
+        Returns:
+            tuple: The JSON encoded frame and its tag, or None if it has none.
+        """
+        message = json.loads(record["payload"]) if "payload" in record else {}
+        message["type"] = record["type"]
+        for field, key in (
+            ("room", "room"), ("username", "user"), ("recipient", "to")
+        ):
+            if record.get(key) is not None:
+                message[field] = record[key]
+
+        tag = None
+        if record["type"] == "RESUME_ROOM":
+            if ticket:
+                message["ticket"] = ticket
+            else:
+                message = self.join_message(
+                    message.get("room"), message.get("username")
+                )
+        elif record["type"] == "JOIN_ROOM":
+            message["code"] = 200
+            message["public_key"] = self.public_key.save_pkcs1("PEM").decode()
+        elif record["type"] in ("CHAT_MESSAGE", "MEDIA_MESSAGE"):
+            tag = f"{next(self.tags):0{self.TAG_LENGTH}x}"
+            message["message"] = tag.ljust(record["msize"], "0")
+            message.setdefault("code", 200)
+            message.setdefault("filename", "replay.bin")
+        elif record["type"] == "DIRECT_MESSAGE":
+            tag = f"{next(self.tags):0{self.TAG_LENGTH}x}"
+            message["message"] = tag.ljust(record["msize"], "0")
+            message.setdefault("code", 200)
+            if record.get("file"):
+                message.setdefault("filename", "replay.bin")
+        elif record["type"] == "LEAVE_ROOM":
+            message["code"] = 400
+
+        return json.dumps(message), tag
+
+    def join_message(self, room, username):
+        """
+        Builds a JOIN_ROOM message with the replayer's public key.
+
+        Args:
+            room (str): The chat room to join.
+            username (str): The username to join as.
+
+        Returns:
+            dict: The message to be sent.
+        """
+        return {
+            "type": "JOIN_ROOM",
+            "username": username,
+            "room": room,
+            "code": 200,
+            "public_key": self.public_key.save_pkcs1("PEM").decode()
+        }
+
+    def ticket_future(self, room, username):
+        """
+        Returns the future of the next ticket the server hands out to a user.
+
+        Args:
+            room (str): The chat room.
+            username (str): The username.
+
+        Returns:
+            asyncio.Future: The future of the ticket.
+        """
+        future = self.tickets.get((room, username))
+        if future is None or future.done():
+            future = asyncio.get_running_loop().create_future()
+            self.tickets[(room, username)] = future
+        return future
+
+    async def wait_for_ticket(self, room, username):
+        """
+        Waits for the ticket handed out to the replayed join of a user.
+
+        Args:
+            room (str): The chat room.
+            username (str): The username.
+
+        Returns:
+            str: The ticket, or None if the user did not join during the replay.
+        """
+        future = self.tickets.pop((room, username), None)
+        if future is None:
+            return None
+
+        try:
+            return await asyncio.wait_for(future, self.drain)
+        except asyncio.TimeoutError:
+            return None
+
+    async def replay_connection(self, websocket, records, started):
+        """
+        Replays the records of a single connection.
+
+        Args:
+            websocket (websockets.WebSocketClientProtocol): The connection, already open.
+            records (list): The records of the connection.
+            started (float): The loop time the replay started at.
+        """
+        loop = asyncio.get_running_loop()
+        reader = asyncio.create_task(self.receive(websocket))
+
+        for record in records:
+            delay = started + record["t"] / self.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if record["type"] == "DISCONNECT":
+                break
+
+            ticket = None
+            if record["type"] == "RESUME_ROOM":
+                ticket = await self.wait_for_ticket(
+                    record.get("room"), record.get("user")
+                )
+            if record["type"] in ("JOIN_ROOM", "RESUME_ROOM"):
+                self.ticket_future(record.get("room"), record.get("user"))
+
+            frame, tag = self.build_frame(record, ticket)
+            if tag:
+                self.sent_at[tag] = loop.time()
+            await websocket.send(frame)
+            self.frames_sent += 1
+            self.bytes_sent += len(frame)
+            self.last_sent = loop.time()
+
+        # Leave time for in-flight deliveries before closing, recorded
+        # disconnects are delayed by the same amount
+        await asyncio.sleep(self.drain)
+        reader.cancel()
+        await websocket.close()
+
+    async def receive(self, websocket):
+        """
+        Receives relayed messages and records their delivery latency.
+
+        Args:
+            websocket (websockets.WebSocketClientProtocol): The replay connection.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            async for message_raw in websocket:
+                self.bytes_received += len(message_raw)
+                message = json.loads(message_raw)
+                tag = None
+
+                if message["type"] == "SYSTEM_MESSAGE":
+                    if "ticket" in message:
+                        self.ticket_future(
+                            message["room"], message["username"]
+                        ).set_result(message["ticket"])
+                    elif message["code"] == 401:
+                        # Like the clients, join afresh if a resume failed
+                        self.ticket_future(message["room"], message["username"])
+                        await websocket.send(json.dumps(self.join_message(
+                            message["room"], message["username"]
+                        )))
+
+                if message["type"] in (
+                    "USER_MESSAGE", "MEDIA_MESSAGE", "DIRECT_MESSAGE"
+                ):
+                    tag = message["message"][:self.TAG_LENGTH]
+                elif message["type"] == "MEDIA_CHUNK":
+                    if message["seq"] == 0:
+                        self.transfers[message["transfer_id"]] = (
+                            message["message"][:self.TAG_LENGTH]
+                        )
+                    if message["seq"] + 1 == message["total"]:
+                        tag = self.transfers.pop(message["transfer_id"], None)
+
+                if tag in self.sent_at:
+                    self.latencies.append(loop.time() - self.sent_at[tag])
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def run(self):
+        """
+        Replays all records and returns the measured statistics.
+
+        Returns:
+            dict: Throughput and delivery latency statistics.
+        """
+        connections = {}
+        for record in self.records:
+            connections.setdefault(record["c"], []).append(record)
+
+        uri = f"ws://{self.host}:{self.port}"
+        sockets = await asyncio.gather(*[
+            websockets.connect(uri, max_size=None) for _ in connections
+        ])
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*[
+            self.replay_connection(websocket, records, started)
+            for websocket, records in zip(sockets, connections.values())
+        ])
+        elapsed = (self.last_sent or started) - started
+
+        latencies = sorted(self.latencies)
+        stats = {
+            "connections": len(connections),
+            "frames_sent": self.frames_sent,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "duration": elapsed,
+            "frames_per_second": self.frames_sent / elapsed if elapsed > 0 else 0.0,
+            "deliveries": len(latencies),
+            "deliveries_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        }
+        if latencies:
+            stats.update({
+                "latency_mean_ms": statistics.fmean(latencies) * 1000,
+                "latency_p50_ms": percentile(latencies, 50) * 1000,
+                "latency_p95_ms": percentile(latencies, 95) * 1000,
+                "latency_p99_ms": percentile(latencies, 99) * 1000,
+                "latency_max_ms": latencies[-1] * 1000,
+            })
+        return stats
+
+
+def percentile(values, percent):
+    """
+    Returns a percentile of sorted values using the nearest-rank method.
+
+    Args:
+        values (list): The sorted values.
+        percent (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile.
+    """
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[int(index)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded traffic file against a chat server."
+    )
+    parser.add_argument("recording", help="file written by TrafficRecorder")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7081)
+    parser.add_argument(
+        "--speed", type=float, default=1.0,
+        help="replay speed, e.g. 10 replays ten times faster"
+    )
+    parser.add_argument(
+        "--drain", type=float, default=2.0,
+        help="seconds each connection waits for deliveries after its last frame"
+    )
+    parser.add_argument("--json", help="also write the statistics to a file")
+    args = parser.parse_args()
+
+    replayer = TrafficReplayer(
+        args.host, args.port, load_recording(args.recording),
+        args.speed, args.drain
+    )
+    stats = asyncio.run(replayer.run())
+
+    for name, value in stats.items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"{name:>22}: {value}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(stats, file, indent=4)